@@ -0,0 +1,453 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# asyncio server engine, selected with "server_engine: asyncio".
+#
+# Connections, HTTP parsing, authentication, the tarpit and TLS are all
+# handled on the event loop, only the rpc methods themselves run on a
+# bounded pool of threads.  Requests and responses are the same as with
+# the threaded server in main.
+
+import asyncio
+import email.utils
+import http.client
+import importlib
+import io
+import json
+import logging as log
+import signal
+import socket
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+
+# The package exports main() under the same name as the module
+main = importlib.import_module("targetd.main")
+
+MAX_HEADERS = 100
+
+
+class Request(object):
+    """
+    What the rpc methods get of the request, in their `req` argument's
+    main.RequestContext, like the handler object of the threaded server.
+    """
+
+    def __init__(self, client_address, headers):
+        self.client_address = client_address
+        self.headers = headers
+
+
+class AsyncService(object):
+    def __init__(self, sockets, ssl_context=None):
+        # Listening sockets by name, "api" and the optional "local" unix
+        # socket, see main.inherited_sockets
+        self.sockets = sockets
+        self.ssl_context = ssl_context
+        self.workers = main.config["worker_threads"]
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.stopping = None
+        # Requests handed to the executor which haven't completed yet, and
+        # requests turned away because too many were pending
+        self.pending = 0
+        self.rejected = 0
+        # Open connections, and those waiting for their next request
+        self.connections = 0
+        self.idle = set()
+        self.draining = False
+
+    def stats(self):
+        return dict(
+            workers=self.workers,
+            queue_depth=max(self.pending - self.workers, 0),
+            queue_limit=main.config["request_queue_depth"],
+            rejected=self.rejected,
+        )
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    def stop(self, signum):
+        log.info("%s received, shutting down ..." % signum.name)
+        self.stopping.set()
+
+    def reload(self):
+        log.info("SIGHUP received, reloading config ...")
+        # Not on our executor, it waits for the calls running there
+        asyncio.get_running_loop().run_in_executor(None, main.reload_logged)
+
+    def handover(self):
+        log.info("SIGUSR2 received, handing over to a new targetd ...")
+        main.handover(self.sockets)
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop, signum)
+        loop.add_signal_handler(signal.SIGHUP, self.reload)
+        loop.add_signal_handler(signal.SIGUSR2, self.handover)
+
+        servers = [
+            await asyncio.start_server(
+                self._connection,
+                sock=self.sockets["api"],
+                ssl=self.ssl_context,
+                backlog=socket.SOMAXCONN,
+            )
+        ]
+        if "local" in self.sockets:
+            servers.append(
+                await asyncio.start_unix_server(
+                    self._local_connection,
+                    sock=self.sockets["local"],
+                    backlog=socket.SOMAXCONN,
+                )
+            )
+        await loop.run_in_executor(None, main.took_over)
+
+        await self.stopping.wait()
+        # Stop accepting, connections wait in the backlog for whoever serves
+        # the sockets next
+        for server in servers:
+            server.close()
+        main.notify_successor()
+
+        deadline = time.monotonic() + main.config["drain_timeout"]
+        if not await self._drain(deadline):
+            log.warning("Calls still in progress after drain_timeout, exiting anyway")
+        await loop.run_in_executor(None, main.drain_jobs, deadline)
+
+        self.executor.shutdown(wait=False)
+
+    async def _drain(self, deadline):
+        """
+        Finish the requests in progress, until deadline.  Persistent
+        connections are closed after their current request, idle ones right
+        away.
+        """
+        self.draining = True
+        for writer in list(self.idle):
+            writer.close()
+        while self.connections:
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+    async def _connection(self, reader, writer):
+        ssl_object = writer.get_extra_info("ssl_object")
+        if ssl_object is not None:
+            main.count_handshake(ssl_object)
+
+        await self._serve_connection(
+            reader, writer, writer.get_extra_info("peername"), self._authorize
+        )
+
+    async def _local_connection(self, reader, writer):
+        try:
+            client_address = main.peer_address(writer.get_extra_info("socket"))
+        except OSError:
+            writer.close()
+            return
+        await self._serve_connection(
+            reader, writer, client_address, self._authorize_local
+        )
+
+    async def _serve_connection(self, reader, writer, client_address, authorize):
+        requests_served = 0
+        self.connections += 1
+        try:
+            while True:
+                if requests_served:
+                    if self.draining:
+                        break
+                    # Waiting for the next request, _drain closes us meanwhile
+                    self.idle.add(writer)
+                if not await self._request(
+                    reader,
+                    writer,
+                    client_address,
+                    requests_served + 1 >= main.config["keepalive_max_requests"],
+                    authorize,
+                ):
+                    break
+                requests_served += 1
+        except (
+            asyncio.TimeoutError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ConnectionError,
+            ValueError,
+        ):
+            # Idle timeout, client went away or sent garbage
+            pass
+        finally:
+            self.idle.discard(writer)
+            self.connections -= 1
+            writer.close()
+
+    @staticmethod
+    def _timeout():
+        return main.config["keepalive_timeout"] or None
+
+    async def _send(self, writer, data):
+        """
+        Write data, dropping the client when it doesn't read it within
+        keepalive_timeout seconds: a streamed response holds its locks
+        meanwhile.
+        """
+        writer.write(data)
+        timeout = (
+            main.config["keepalive_timeout"] or main.default_config["keepalive_timeout"]
+        )
+        try:
+            await asyncio.wait_for(writer.drain(), timeout)
+        except asyncio.TimeoutError:
+            # Closing would wait for the client to read what's buffered
+            writer.transport.abort()
+            raise
+
+    async def _read_headers(self, reader):
+        lines = []
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self._timeout())
+            if line in (b"\r\n", b"\n", b""):
+                break
+            lines.append(line)
+            if len(lines) > MAX_HEADERS:
+                raise asyncio.LimitOverrunError("too many headers", 0)
+        return http.client.parse_headers(io.BytesIO(b"".join(lines) + b"\r\n"))
+
+    @staticmethod
+    def _head(code, headers):
+        lines = [
+            "HTTP/1.1 %d %s" % (code, BaseHTTPRequestHandler.responses[code][0]),
+            # As BaseHTTPRequestHandler.version_string() for the threading engine
+            "Server: %s %s"
+            % (
+                BaseHTTPRequestHandler.server_version,
+                BaseHTTPRequestHandler.sys_version,
+            ),
+            "Date: %s" % email.utils.formatdate(usegmt=True),
+        ]
+        lines.extend("%s: %s" % h for h in headers)
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1", "strict")
+
+    async def _send_error(self, writer, code, headers=()):
+        short, explain = BaseHTTPRequestHandler.responses[code]
+        body = (
+            BaseHTTPRequestHandler.error_message_format
+            % dict(code=code, message=short, explain=explain)
+        ).encode("UTF-8", "replace")
+        await self._send(
+            writer,
+            self._head(
+                code,
+                [
+                    ("Connection", "close"),
+                    ("Content-Type", BaseHTTPRequestHandler.error_content_type),
+                    ("Content-Length", len(body)),
+                ]
+                + list(headers),
+            )
+            + body,
+        )
+
+    async def _authorize(self, writer, headers, client_address):
+        """
+        Check the credentials sent with a request, returns False when it was
+        answered with an error.
+        """
+        try:
+            in_user, in_pass = main.credentials(headers)
+        except Exception:
+            log.error(traceback.format_exc())
+            await self._send_error(writer, 400)
+            return False
+
+        if main.tar.is_stuck(client_address[0]):
+            log.warning(
+                "Concurrent authentication attempts from %s" % client_address[0]
+            )
+            # This client already has a failed authentication attempt,
+            # immediately return error without trying new credentials.
+            await self._send_error(writer, 503)
+            return False
+
+        if not main.authenticated(in_user, in_pass):
+            # Tarpit the bad authentication for a bit, without holding up
+            # anybody else.
+            with main.tar.pitted(client_address[0]):
+                await asyncio.sleep(main.tar.failed(client_address[0]))
+                await self._send_error(writer, 401)
+            return False
+
+        return True
+
+    async def _authorize_local(self, writer, headers, client_address):
+        # No password, the socket permissions and the uid of the client
+        # decide
+        if main.local_authorized(client_address[2]):
+            return True
+
+        log.warning("Refusing local client %s" % (client_address,))
+        await self._send_error(writer, 403)
+        return False
+
+    async def _request(self, reader, writer, client_address, last, authorize):
+        """
+        Reads and answers one request, returns True when the connection can
+        be used for the next one.  last is set for the last request we are
+        willing to serve on this connection.  authorize checks the request
+        is allowed, see _authorize.
+        """
+        request_line = await asyncio.wait_for(reader.readline(), self._timeout())
+        self.idle.discard(writer)
+        if not request_line:
+            return False
+
+        try:
+            command, path, version = request_line.decode("iso-8859-1").split()
+        except ValueError:
+            await self._send_error(writer, 400)
+            return False
+
+        headers = await self._read_headers(reader)
+
+        connection = headers.get("Connection", "").lower()
+        if version == "HTTP/1.0":
+            keep_alive = connection == "keep-alive"
+        else:
+            keep_alive = connection != "close"
+        keep_alive = keep_alive and bool(main.config["keepalive_timeout"]) and not last
+
+        if command != "POST":
+            await self._send_error(writer, 501)
+            return False
+
+        if headers.get("Expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+        if not await authorize(writer, headers, client_address):
+            return False
+
+        if not path == "/targetrpc":
+            log.error("Invalid URL %s" % path)
+            await self._send_error(writer, 404)
+            return False
+
+        try:
+            error = (-1, "jsonrpc error")
+            try:
+                content_len = int(headers.get("content-length"))
+
+                if content_len > main.MAX_CONTENT_LENGTH:
+                    log.error(
+                        "client %s, content-length = %d rejecting!"
+                        % (client_address[0], content_len)
+                    )
+                    await self._send_error(writer, 413)
+                    return False
+
+                body = await asyncio.wait_for(
+                    reader.readexactly(content_len), self._timeout()
+                )
+                rpc = json.loads(body.decode("utf-8"))
+            except ValueError:
+                # see http://www.jsonrpc.org/specification for errcodes
+                error = (-32700, "parse error")
+                raise
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            raise
+        except Exception:
+            log.debug(traceback.format_exc())
+            log.debug("Error=%s, msg=%s" % (error[0], error[1]))
+            # Same as the threaded server: no HTTP framing, just the error
+            await self._send(
+                writer, json.dumps(main.rpc_error(error, 0)).encode("utf-8")
+            )
+            return False
+
+        if self.pending >= self.workers + main.config["request_queue_depth"]:
+            self.rejected += 1
+            log.warning("Busy, turning away request from %s" % (client_address,))
+            await self._send_error(
+                writer, 503, [("Retry-After", main.config["busy_retry_after"])]
+            )
+            return False
+
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            rpcdata = await loop.run_in_executor(
+                self.executor,
+                main.rpc_response,
+                Request(client_address, headers),
+                rpc,
+                # Chunked encoding needs HTTP/1.1
+                version != "HTTP/1.0",
+            )
+
+            # Compressing a large response takes a while too
+            response_headers, rpcdata = await loop.run_in_executor(
+                self.executor,
+                main.http_response,
+                rpcdata,
+                headers.get("Accept-Encoding"),
+            )
+            # We may have started draining meanwhile
+            keep_alive = keep_alive and not self.draining
+            if not keep_alive:
+                response_headers.append(("Connection", "close"))
+
+            if isinstance(rpcdata, bytes):
+                await self._send(writer, self._head(200, response_headers) + rpcdata)
+                return keep_alive
+
+            fetch = None
+            try:
+                await self._send(writer, self._head(200, response_headers))
+                # The rest of the result is produced chunk by chunk on the
+                # executor, each one sent before the next is asked for.
+                while True:
+                    fetch = self.executor.submit(next, rpcdata, None)
+                    chunk = await asyncio.wrap_future(fetch)
+                    if chunk is None:
+                        break
+                    await self._send(writer, b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                await self._send(writer, b"0\r\n\r\n")
+            except asyncio.TimeoutError:
+                log.warning(
+                    "Client %s stopped reading its response, dropped it"
+                    % (client_address,)
+                )
+                return False
+            except Exception as e:
+                # Too late for an error response, the missing last chunk
+                # tells the client the response is incomplete.
+                log.error("Streaming response failed: %s" % e)
+                log.debug(traceback.format_exc())
+                return False
+            finally:
+                if fetch is None or fetch.done():
+                    rpcdata.close()
+                else:
+                    # Cancelled while the executor runs the generator, it
+                    # can only be closed once it's done
+                    fetch.add_done_callback(lambda f: rpcdata.close())
+        finally:
+            self.pending -= 1
+
+        return keep_alive
@@ -16,11 +16,10 @@
 #
 # fs support using btrfs.
 
-import logging as log
 import os
 import time
 
-from targetd.utils import invoke, TargetdError
+from targetd.utils import check_concurrently, invoke, retrying, TargetdError
 
 # Notes:
 #
@@ -47,18 +46,29 @@ pools = []
 
 
 def fs_initialize(config_dict, init_pools):
-
+    """
+    Also called on config reload, the pools we already have aren't checked
+    again.
+    """
     global pools
-    pools = [fs["mount"] for fs in init_pools]
+    mounts = [fs["mount"] for fs in init_pools]
+    passed = check_concurrently(
+        [m for m in mounts if m not in pools],
+        _check_pool,
+        config_dict["pool_check_workers"],
+    )
+    pools = [m for m in mounts if m in pools or m in passed]
 
-    for pool in pools:
-        # Make sure we have the appropriate subvolumes available
-        try:
-            create_sub_volume(os.path.join(pool, fs_path))
-            create_sub_volume(os.path.join(pool, ss_path))
-        except TargetdError as e:
-            log.error("Unable to create required subvolumes {0} (Btrfs)".format(e))
-            raise
+
+def _check_pool(pool):
+    # Make sure we have the appropriate subvolumes available
+    try:
+        create_sub_volume(os.path.join(pool, fs_path))
+        create_sub_volume(os.path.join(pool, ss_path))
+    except TargetdError as e:
+        raise TargetdError(
+            e.error, "Unable to create required subvolumes {0} (Btrfs)".format(e)
+        )
 
 
 def create_sub_volume(p):
@@ -175,6 +185,7 @@ def _invoke_retries(command, throw_exception):
             return result, out, err
         elif result == 19:
             time.sleep(1)
+            retrying(command)
             continue
         else:
             raise TargetdError(
@@ -189,10 +200,13 @@ def _invoke_retries(command, throw_exception):
     )
 
 
-def fs_hash():
+def fs_hash(pool_name=None, name_prefix=None):
     fs_list = {}
 
     for pool in pools:
+        if pool_name is not None and pool != pool_name:
+            continue
+
         full_path = os.path.join(pool, fs_path)
 
         result, out, err = _invoke_retries(
@@ -208,9 +222,12 @@ def fs_hash():
                 prefix = fs_path + os.path.sep
 
                 if sub_vol[: len(prefix)] == prefix:
+                    name = sub_vol[len(prefix) :]
+                    if name_prefix and not name.startswith(name_prefix):
+                        continue
                     key = os.path.join(pool, sub_vol)
                     fs_list[key] = dict(
-                        name=sub_vol[len(prefix) :],
+                        name=name,
                         uuid=e[8],
                         total_space=total,
                         free_space=free,
@@ -221,12 +238,13 @@ def fs_hash():
     return fs_list
 
 
-def ss(req, pool, name):
+def ss(req, pool, name, name_prefix=None):
     """
         Returns the snapshots belonging to this filesystem
     :param req:
     :param pool: pool of the filesystem
     :param name: name of the subvol of this filesystem
+    :param name_prefix: only the snapshots whose name starts with it
     :return: list of snapshots
     """
     snapshots = []
@@ -241,6 +259,8 @@ def ss(req, pool, name):
         data = split_stdout(out)
         if len(data):
             for e in data:
+                if name_prefix and not e[-1].startswith(name_prefix):
+                    continue
                 ts = "%s %s" % (e[10], e[11])
                 time_epoch = int(time.mktime(time.strptime(ts, "%Y-%m-%d %H:%M:%S")))
                 st = dict(name=e[-1], uuid=e[-3], timestamp=time_epoch)
@@ -30,6 +30,7 @@ except ValueError:
     bd.switch_init_checks(False)
 
 from targetd.main import TargetdError
+from targetd.utils import check_concurrently
 
 REQUESTED_PLUGIN_NAMES = {"lvm"}
 
@@ -57,23 +58,6 @@ def get_vg_lv(pool_name):
         return pool_name, None
 
 
-def has_pool(pool_name):
-    """
-    This can be used to check if module owns given pool without raising
-    exception
-    """
-    pool_to_check = get_vg_lv(pool_name)[0]
-    return pool_to_check in [get_vg_lv(x)[0] for x in pools]
-
-
-def has_udev_path(udev_path):
-    try:
-        mlun_vg, mlun_name = split_udev_path(udev_path)
-    except (IndexError, ValueError, TypeError):
-        return False
-    return has_pool(mlun_vg)
-
-
 def split_udev_path(udev_path):
     return udev_path.split("/")[2:]
 
@@ -108,87 +92,91 @@ def so_name2pool_volume(so_name):
     return dev2pool_name(vg_name), vol_name
 
 
-def has_so_name(so_name):
-    pool_name, vol_name = so_name.split(":")
-    return has_pool(pool_name)
-
-
 def get_dev_path(pool_name, vol_name):
     return "/dev/%s/%s" % (pool2dev_name(pool_name), vol_name)
 
 
 def initialize(config_dict, init_pools):
+    """
+    Also called on config reload, the pools we already have aren't checked
+    again.
+    """
     global pools
-    check_pools_access(init_pools)
-    pools = init_pools
-    for pool_name in pools:
-        vg_name = get_vg_lv(pool_name)[0]
-        vg_name_2_pool_name_dict[vg_name] = pool_name
+    global vg_name_2_pool_name_dict
+    pools = check_pools_access(
+        init_pools, config_dict["pool_check_workers"], known=pools
+    )
+    vg_name_2_pool_name_dict = dict(
+        (get_vg_lv(pool_name)[0], pool_name) for pool_name in pools
+    )
 
 
-def check_pools_access(check_pools):
+def check_pools_access(check_pools, workers=8, known=()):
+    """
+    Returns the pools of check_pools which can be used, those in known and
+    those passing their check, the others are logged.  Raises on
+    configurations we don't support.
+    """
+    # Allowed multi-pool configs:
+    # two thinpools from a single vg: ok
+    # two vgs: ok
+    # vg and a thinpool from that vg: BAD
+    #
     for pool in check_pools:
-        thinp = None
-        error = ""
         vg_name, thin_pool = get_vg_lv(pool)
-
-        if vg_name and thin_pool:
-            # We have VG name and LV name, check for it!
-            try:
-                thinp = bd.lvm.lvinfo(vg_name, thin_pool)
-            except bd.LVMError as lve:
-                error = str(lve).strip()
-
-            if thinp is None:
-                raise TargetdError(
-                    TargetdError.NOT_FOUND_VOLUME_GROUP,
-                    "VG with thin LV {} not found, "
-                    "nested error: {}".format(pool, error),
-                )
-        else:
-            try:
-                bd.lvm.vginfo(vg_name)
-            except bd.LVMError as vge:
-                error = str(vge).strip()
-                raise TargetdError(
-                    TargetdError.NOT_FOUND_VOLUME_GROUP,
-                    "VG pool {} not found, " "nested error: {}".format(vg_name, error),
-                )
-
-        # Allowed multi-pool configs:
-        # two thinpools from a single vg: ok
-        # two vgs: ok
-        # vg and a thinpool from that vg: BAD
-        #
         if thin_pool and vg_name in check_pools:
             raise TargetdError(
                 TargetdError.INVALID, "VG pool and thin pool from same VG not supported"
             )
 
-    return
+    passed = check_concurrently(
+        [p for p in check_pools if p not in known], _check_pool_access, workers
+    )
+    return [p for p in check_pools if p in known or p in passed]
+
+
+def _check_pool_access(pool):
+    thinp = None
+    error = ""
+    vg_name, thin_pool = get_vg_lv(pool)
+
+    if vg_name and thin_pool:
+        # We have VG name and LV name, check for it!
+        try:
+            thinp = bd.lvm.lvinfo(vg_name, thin_pool)
+        except bd.LVMError as lve:
+            error = str(lve).strip()
+
+        if thinp is None:
+            raise TargetdError(
+                TargetdError.NOT_FOUND_VOLUME_GROUP,
+                "VG with thin LV {} not found, " "nested error: {}".format(pool, error),
+            )
+    else:
+        try:
+            bd.lvm.vginfo(vg_name)
+        except bd.LVMError as vge:
+            error = str(vge).strip()
+            raise TargetdError(
+                TargetdError.NOT_FOUND_VOLUME_GROUP,
+                "VG pool {} not found, " "nested error: {}".format(vg_name, error),
+            )
 
 
 def volumes(req, pool):
-    output = []
     vg_name, lv_pool = get_vg_lv(pool)
     for lv in bd.lvm.lvs(vg_name):
         attrib = lv.attr
         if not lv_pool:
             if attrib[0] == "-":
-                output.append(dict(name=lv.lv_name, size=lv.size, uuid=lv.uuid))
+                yield dict(name=lv.lv_name, size=lv.size, uuid=lv.uuid)
         else:
             if attrib[0] == "V" and lv.pool_lv == lv_pool:
-                output.append(dict(name=lv.lv_name, size=lv.size, uuid=lv.uuid))
-
-    return output
+                yield dict(name=lv.lv_name, size=lv.size, uuid=lv.uuid)
 
 
 def create(req, pool, name, size):
-    # Check to ensure that we don't have a volume with this name already,
-    # lvm will fail if we try to create a LV with a duplicate name
-    if any(v["name"] == name for v in volumes(req, pool)):
-        raise TargetdError(TargetdError.NAME_CONFLICT, "Volume with that name exists")
-
+    # block.create checked there is no volume with this name already
     vg_name, lv_pool = get_vg_lv(pool)
     if lv_pool:
         # Fall back to non-thinp if needed
@@ -210,9 +198,6 @@ def copy(req, pool, vol_orig, vol_new, size, timeout=10):
     Create a new volume that is a copy of an existing one.
     Since 0.6, requires thinp support.
     """
-    if any(v["name"] == vol_new for v in volumes(req, pool)):
-        raise TargetdError(TargetdError.NAME_CONFLICT, "Volume with that name exists")
-
     vg_name, thin_pool = get_vg_lv(pool)
 
     if not thin_pool:
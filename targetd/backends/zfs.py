@@ -17,12 +17,14 @@
 import shutil
 import logging
 import re
-import subprocess
 from time import time, sleep
 
 from targetd.main import TargetdError
+from targetd.utils import run, retrying
 
 pools = []
+# The same, for looking them up
+pool_names = frozenset()
 pools_fs = dict()
 zfs_cmd = ""
 zfs_enable_copy = False
@@ -42,14 +44,6 @@ class VolInfo(object):
         self.size = size
 
 
-def has_pool(pool_name):
-    """
-    This can be used to check if module owns given pool without raising
-    exception
-    """
-    return pool_name in pools
-
-
 def has_fs_pool(pool_name):
     """
     This can be used to check if module owns given fs_pool without raising
@@ -58,19 +52,11 @@ def has_fs_pool(pool_name):
     return pool_name in pools_fs
 
 
-def has_udev_path(udev_path):
-    try:
-        pool, dataset = split_udev_path(udev_path)
-    except (IndexError, ValueError, TypeError):
-        return False
-    return True
-
-
 def split_udev_path(udev_path):
-    dataset = udev_path.split("/", 2)[2]
-    for p in pools:
-        if dataset.startswith(p + "/"):
-            return p, dataset.replace(p + "/", "", 1)
+    # Volume names have no slashes, see _check_dataset_name
+    pool, _, volume = udev_path.split("/", 2)[2].rpartition("/")
+    if pool in pool_names:
+        return pool, volume
 
 
 def pool2dev_name(pool):
@@ -101,30 +87,29 @@ def so_name2pool_volume(so_name):
     return pool_name, vol_name
 
 
-def has_so_name(so_name):
-    pool_name, vol_name = so_name.split(":")
-    pool_name = pool_name.replace("%", "/")
-    return has_pool(pool_name)
-
-
 def get_dev_path(pool_name, vol_name):
     return "/dev/%s/%s" % (pool2dev_name(pool_name), vol_name)
 
 
 def initialize(config_dict, init_pools):
     global pools
+    global pool_names
     global zfs_enable_copy
     zfs_enable_copy = zfs_enable_copy or config_dict["zfs_enable_copy"]
-    check_pools_access(init_pools)
-    pools = init_pools
+    pools = check_pools_access(init_pools, known=pools)
+    pool_names = frozenset(pools)
 
 
 def fs_initialize(config_dict, init_pools):
     global pools_fs
     global zfs_enable_copy
     zfs_enable_copy = zfs_enable_copy or config_dict["zfs_enable_copy"]
-    pools_fs = {fs["mount"]: fs["device"] for fs in init_pools}
-    check_pools_access(list(pools_fs.values()))
+    devices = check_pools_access(
+        [fs["device"] for fs in init_pools], known=list(pools_fs.values())
+    )
+    pools_fs = {
+        fs["mount"]: fs["device"] for fs in init_pools if fs["device"] in devices
+    }
 
 
 def _check_dataset_name(name):
@@ -152,24 +137,22 @@ def _zfs_exec_command(args=None):
         args = []
 
     for _ in range(3):
-        proc = subprocess.Popen(
-            [zfs_cmd] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        (out, err) = proc.communicate()
-        if proc.returncode != 0:
+        returncode, out, err = run([zfs_cmd] + args)
+        if returncode != 0:
             logging.debug(
                 "zfs command returned non-zero status: %s, %s. Stderr: %s. Stdout: %s"
-                % (proc.returncode, args, out, err)
+                % (returncode, args, out, err)
             )
             # See: https://github.com/openzfs/zfs/issues/1810
             if b"dataset is busy" in err:
                 sleep(1)
                 logging.debug("Retrying on 'dataset is busy' error ...")
+                retrying([zfs_cmd] + args)
                 continue
             else:
-                return proc.returncode, out, err
+                return returncode, out, err
         else:
-            return proc.returncode, out, err
+            return returncode, out, err
 
 
 def _zfs_get(datasets, properties, recursive=False, fstype="all"):
@@ -191,7 +174,12 @@ def _zfs_get(datasets, properties, recursive=False, fstype="all"):
     return result
 
 
-def check_pools_access(check_pools):
+def check_pools_access(check_pools, known=()):
+    """
+    Returns the datasets of check_pools which can be used, those in known
+    and those passing their check, the others are logged.  Raises on
+    configurations we don't support.
+    """
     if any([s.startswith(i + "/") for s in check_pools for i in check_pools]):
         raise TargetdError(
             TargetdError.INVALID,
@@ -203,23 +191,36 @@ def check_pools_access(check_pools):
 
     if len(check_pools) == 0:
         logging.debug("No ZFS pool defined, skipping ZFS")
-        return
+        return []
+
+    unknown = [p for p in check_pools if p not in known]
+    if len(unknown) == 0:
+        return list(check_pools)
 
     _zfs_find_cmd()
 
-    props = _zfs_get(check_pools, ["type", "name"])
+    # All of them with a single command, there is nothing to run in parallel
+    props = _zfs_get(unknown, ["type", "name"])
 
+    passed = []
     for p in check_pools:
-        if p not in props or "type" not in props[p]:
-            raise TargetdError(
-                TargetdError.INVALID, "ZFS dataset does not exist: %s" % (p,)
-            )
-        if props[p]["type"] != "filesystem":
-            raise TargetdError(
-                TargetdError.INVALID,
-                "ZFS dataset must be of 'filesystem' type. %s is %s"
-                % (p, props[p]["type"]),
+        if p in known:
+            error = None
+        elif p not in props or "type" not in props[p]:
+            error = "ZFS dataset does not exist: %s" % (p,)
+        elif props[p]["type"] != "filesystem":
+            error = "ZFS dataset must be of 'filesystem' type. %s is %s" % (
+                p,
+                props[p]["type"],
             )
+        else:
+            error = None
+
+        if error is None:
+            passed.append(p)
+        else:
+            logging.error("Pool %s is not available: %s" % (p, error))
+    return passed
 
 
 def block_pools(req):
@@ -246,23 +247,21 @@ def volumes(req, pool):
     allprops = _zfs_get([pool], ["volsize", "guid"], True, "volume")
     results = []
     for fullname, props in allprops.items():
-        results.append(
-            dict(
-                name=fullname.replace(pool + "/", "", 1),
-                size=int(props["volsize"]),
-                uuid=props["guid"],
-            )
-        )
+        name = fullname.replace(pool + "/", "", 1)
+        results.append(dict(name=name, size=int(props["volsize"]), uuid=props["guid"]))
     return results
 
 
-def fs_hash():
+def fs_hash(pool_name=None, name_prefix=None):
     if not zfs_cmd:
         return {}
 
     fs_list = {}
 
     for pool, zfs_pool in pools_fs.items():
+        if pool_name is not None and pool != pool_name:
+            continue
+
         allprops = _zfs_get(
             [zfs_pool],
             ["name", "mountpoint", "guid", "used", "available"],
@@ -275,6 +274,8 @@ def fs_hash():
                 continue
 
             sub_vol = fullname.replace(zfs_pool + "/", "", 1)
+            if name_prefix and not sub_vol.startswith(name_prefix):
+                continue
 
             key = props["name"]
             fs_list[key] = dict(
@@ -432,7 +433,7 @@ def resize(req, pool, name, size):
         raise TargetdError(TargetdError.UNEXPECTED_EXIT_CODE, "Failed to resize volume")
 
 
-def ss(req, pool, name):
+def ss(req, pool, name, name_prefix=None):
     snapshots = []
 
     zfs_pool = pools_fs[pool]
@@ -451,9 +452,12 @@ def ss(req, pool, name):
                 " create subvolumes underneath targetd managed subvolumes"
             )
             continue
+        ss_name = props["name"].replace((zfs_pool + "/" + name + "@"), "", 1)
+        if name_prefix and not ss_name.startswith(name_prefix):
+            continue
         time_epoch = int(props["creation"])
         st = dict(
-            name=props["name"].replace((zfs_pool + "/" + name + "@"), "", 1),
+            name=ss_name,
             uuid=props["guid"],
             timestamp=time_epoch,
         )
@@ -15,6 +15,10 @@
 #
 # Routines to export block devices over iscsi.
 
+import contextlib
+import importlib
+from threading import Lock
+
 from rtslib_fb import (
     Target,
     TPG,
@@ -30,9 +34,10 @@ from rtslib_fb import (
     NodeACLGroup,
 )
 
-from targetd.backends import lvm, zfs
+from targetd import lio, locks, stats
+from targetd.inventory import Inventory
 from targetd.main import TargetdError
-from targetd.utils import ignored, name_check
+from targetd.utils import ignored, name_check, paginate
 
 # Handle changes in rtslib_fb for the constant expressing maximum LUN number
 # https://github.com/open-iscsi/rtslib-fb/commit/20a50d9967464add8d33f723f6849a197dbe0c52
@@ -48,34 +53,77 @@ def set_portal_addresses(tpg):
         NetworkPortal(tpg, a)
 
 
-pool_modules = {"zfs": zfs, "lvm": lvm}
+# Backends of the pool types configured, loaded by initialize()
+pool_modules = dict()
 target_name = ""
 addresses = []
+all_pools = []
+# What we know of the pools' volumes, created by initialize()
+inventory = Inventory()
+# What we know of our target in LIO, read when first needed, see _lio()
+lio_tpg = None
+lio_lock = Lock()
+# The backend of each pool by pool name, by dev name (the VG with lvm) and
+# by storage object name prefix, see _routes().  Replaced as a whole by
+# initialize(), never changed.
+routes = dict(pools=dict(), devs=dict(), so_names=dict())
+
+
+def _routes(modules):
+    pools = dict()
+    devs = dict()
+    so_names = dict()
+    # The first backend claiming a name gets it
+    for mod in modules:
+        for pool in mod.pools:
+            pools.setdefault(pool, mod)
+            devs.setdefault(mod.pool2dev_name(pool), mod)
+            so_names.setdefault(mod.get_so_name(pool, "").partition(":")[0], mod)
+    return dict(pools=pools, devs=devs, so_names=so_names)
+
+
+def _route(table, key):
+    try:
+        return routes[table][key]
+    except (KeyError, TypeError):
+        return None
+
+
+def _udev_path_route(udev_path):
+    # /dev/<dev name>/<volume>, the dev name of zfs pools has slashes too
+    try:
+        dev = udev_path.split("/", 2)[2].rpartition("/")[0]
+    except (AttributeError, IndexError):
+        return None
+    return _route("devs", dev)
 
 
 def pool_module(pool_name):
-    for modname, mod in pool_modules.items():
-        if mod.has_pool(pool_name):
-            return mod
-    raise TargetdError(TargetdError.INVALID_POOL, "Invalid pool (%s)" % pool_name)
+    mod = _route("pools", pool_name)
+    if mod is None:
+        raise TargetdError(TargetdError.INVALID_POOL, "Invalid pool (%s)" % pool_name)
+    return mod
 
 
 def udev_path_module(udev_path):
-    for modname, mod in pool_modules.items():
-        if mod.has_udev_path(udev_path):
-            return mod
-    raise TargetdError(
-        TargetdError.INVALID_POOL, "Pool not found by udev path (%s)" % udev_path
-    )
+    mod = _udev_path_route(udev_path)
+    if mod is None:
+        raise TargetdError(
+            TargetdError.INVALID_POOL, "Pool not found by udev path (%s)" % udev_path
+        )
+    return mod
 
 
 def so_name_module(so_name):
-    for modname, mod in pool_modules.items():
-        if mod.has_so_name(so_name):
-            return mod
-    raise TargetdError(
-        TargetdError.INVALID_POOL, "Pool not found by storage object (%s)" % so_name
-    )
+    mod = None
+    if isinstance(so_name, str):
+        mod = _route("so_names", so_name.partition(":")[0])
+    if mod is None:
+        raise TargetdError(
+            TargetdError.INVALID_POOL,
+            "Pool not found by storage object (%s)" % so_name,
+        )
+    return mod
 
 
 #
@@ -86,21 +134,54 @@ def initialize(config_dict):
     pools["lvm"] = list(config_dict["block_pools"])
     pools["zfs"] = list(config_dict["zfs_block_pools"])
 
-    global target_name
-    target_name = config_dict["target_name"]
-
-    global addresses
-    addresses = config_dict["portal_addresses"]
-
     if any(i in pools["zfs"] for i in pools["lvm"]):
         raise TargetdError(
             TargetdError.INVALID,
             "Conflicting names in zfs_block_pools and block_pools in config.",
         )
 
-    # initialize and check both pools
-    for modname, mod in pool_modules.items():
-        mod.initialize(config_dict, pools[modname])
+    # On config reload, what we know of the pools kept and of our target
+    # stays, unless they are set up differently
+    global target_name
+    if config_dict["target_name"] != target_name:
+        _forget_lio()
+    target_name = config_dict["target_name"]
+
+    global addresses
+    addresses = config_dict["portal_addresses"]
+
+    global inventory
+    if config_dict["inventory_ttl"] != inventory.ttl:
+        inventory = Inventory(config_dict["inventory_ttl"])
+
+    # Only load and check the backends we have pools for, the lvm one
+    # loads and initializes libblockdev.  On config reload, the backends
+    # loaded before drop the pools which are gone.
+    for modname in ("zfs", "lvm"):
+        if modname not in pool_modules:
+            if not pools[modname]:
+                continue
+            with stats.startup.step("%s import" % modname):
+                pool_modules[modname] = importlib.import_module(
+                    "targetd.backends." + modname
+                )
+        with stats.startup.step("%s initialize" % modname):
+            pool_modules[modname].initialize(config_dict, pools[modname])
+
+    # The pools which passed their checks
+    global all_pools
+    previous = all_pools
+    all_pools = [
+        p
+        for modname in ("lvm", "zfs")
+        if modname in pool_modules
+        for p in pool_modules[modname].pools
+    ]
+    for p in set(previous) - set(all_pools):
+        inventory.forget(p)
+
+    global routes
+    routes = _routes(pool_modules.values())
 
     return dict(
         vol_list=volumes,
@@ -124,15 +205,214 @@ def initialize(config_dict):
     )
 
 
-def volumes(req, pool):
-    return pool_module(pool).volumes(req, pool)
+def _all_pools_locked(params):
+    return [locks.block_pool(p) for p in all_pools]
+
+
+def _pool_locked(key, *others):
+    """
+    Returns a function giving the resources used by a method working on the
+    pool passed as `key` parameter, plus the `others` resources.
+    """
+
+    def resources(params):
+        if params.get(key) is not None:
+            return [locks.block_pool(params[key])] + list(others)
+        return _all_pools_locked(params) + list(others)
+
+    return resources
+
+
+def _lio_locked(params):
+    return [locks.LIO]
+
+
+# Resources each method works on, locked by main while the method runs
+lock_resources = dict(
+    vol_list=_pool_locked("pool"),
+    vol_create=_pool_locked("pool"),
+    vol_destroy=_pool_locked("pool", locks.LIO),
+    vol_copy=_pool_locked("pool"),
+    vol_resize=_pool_locked("pool"),
+    export_list=_pool_locked("pool", locks.LIO),
+    export_create=_pool_locked("pool", locks.LIO),
+    export_destroy=_pool_locked("pool", locks.LIO),
+    initiator_set_auth=_lio_locked,
+    initiator_list=_lio_locked,
+    access_group_list=_lio_locked,
+    access_group_create=_lio_locked,
+    access_group_destroy=_lio_locked,
+    access_group_init_add=_lio_locked,
+    access_group_init_del=_lio_locked,
+    access_group_map_list=_lio_locked,
+    access_group_map_create=_pool_locked("pool_name", locks.LIO),
+    access_group_map_destroy=_pool_locked("pool_name", locks.LIO),
+)
+
+# Methods which don't change anything, they share their locks
+read_only = frozenset(
+    [
+        "vol_list",
+        "export_list",
+        "initiator_list",
+        "access_group_list",
+        "access_group_map_list",
+    ]
+)
+
+# Methods which may take long, clients can run them as a job
+async_capable = frozenset(["vol_copy", "vol_resize"])
+
+
+def _volumes_of(req, pool):
+    # Lists the volumes of pool for the inventory, once per call
+    return lambda: req.memo(
+        ("volumes", pool), lambda: list(pool_module(pool).volumes(req, pool))
+    )
+
+
+def _forget_volumes(req, pool):
+    inventory.forget(pool)
+    req.forget(("volumes", pool))
+
+
+def _volume(req, pool, name):
+    """
+    Returns the volume of pool, raises when there is none.
+    """
+    vol = inventory.volume(pool, name, _volumes_of(req, pool))
+    if vol is None:
+        raise TargetdError(
+            TargetdError.NOT_FOUND_VOLUME,
+            "Volume %s not found in pool %s" % (name, pool),
+        )
+    return vol
+
+
+def vol_info(req, pool, name):
+    """
+    Returns the volume of pool for the LIO methods, which find it in the
+    LUN mappings: when we don't know it the inventory is out of date.
+    """
+    vol = inventory.volume(pool, name, _volumes_of(req, pool))
+    if vol is None:
+        _forget_volumes(req, pool)
+        vol = _volume(req, pool, name)
+    return vol
+
+
+@contextlib.contextmanager
+def _changing(req, pool, name):
+    """
+    Writes volume name of pool through to the inventory once the with block
+    created or changed it.  Should that fail midway, the pool is listed
+    again instead.
+    """
+    try:
+        yield
+    except BaseException:
+        _forget_volumes(req, pool)
+        raise
+
+    req.forget(("volumes", pool))
+    try:
+        info = pool_module(pool).vol_info(pool, name)
+        vol = dict(name=name, size=int(info.size), uuid=info.uuid)
+    except Exception:
+        # The change was made, don't fail the call for it
+        inventory.forget(pool)
+    else:
+        inventory.update(pool, name, vol)
+
+
+def _read_lio():
+    try:
+        fm = FabricModule("iscsi")
+        t = Target(fm, target_name, mode="lookup")
+        tpg = TPG(t, 1, mode="lookup")
+    except RTSLibNotInCFS:
+        return lio.Tpg()
+
+    model = lio.Tpg(tpg)
+    for lun in tpg.luns:
+        so = lun.storage_object
+        # Ours are all block storage objects
+        udev_path = so.udev_path if so.plugin == "block" else None
+        model.add_lun(lun.lun, so.name, so.plugin, udev_path)
+    for na in tpg.node_acls:
+        model.add_acl(na.node_wwn, na.tag)
+        for mlun in na.mapped_luns:
+            model.map(na.node_wwn, mlun.mapped_lun, mlun.tpg_lun.lun)
+    return model
+
+
+def _lio():
+    """
+    Returns our model of the target in LIO, a lio.Tpg, read from configfs
+    when we don't have it.  Calls reading it hold locks.LIO shared, those
+    changing it hold it exclusively.
+    """
+    global lio_tpg
+    with lio_lock:
+        if lio_tpg is None:
+            lio_tpg = _read_lio()
+        return lio_tpg
+
+
+def _forget_lio():
+    global lio_tpg
+    with lio_lock:
+        lio_tpg = None
+
+
+@contextlib.contextmanager
+def _changing_lio():
+    """
+    Yields the model of our target for the with block to change LIO and
+    the model alike, the LIO configuration is saved afterwards.  Should the
+    with block fail midway, the model is read again instead.
+    """
+    model = _lio()
+    try:
+        yield model
+    except BaseException:
+        _forget_lio()
+        raise
+    RTSRoot().save_to_file()
+
+
+def _lio_target_tpg(model):
+    # The rtslib TPG to make changes with, creating our target if needed
+    if model.tpg is None:
+        model.tpg = _get_iscsi_tpg()
+    return model.tpg
+
+
+def _remove_lun(model, index):
+    # Delete LUN index and its storage object, nobody uses them anymore
+    tpg_lun = LUN(model.tpg, index)
+    so = tpg_lun.storage_object
+    tpg_lun.delete()
+    so.delete()
+    model.remove_lun(index)
+
+
+def volumes(req, pool, name_prefix=None, limit=None, marker=None):
+    yield from paginate(
+        (
+            v
+            for v in inventory.volumes(pool, _volumes_of(req, pool))
+            if not name_prefix or v["name"].startswith(name_prefix)
+        ),
+        lambda v: (v["name"],),
+        limit,
+        marker,
+    )
 
 
 def check_vol_exists(req, pool, name):
-    mod = pool_module(pool)
-    if any(v["name"] == name for v in mod.volumes(req, pool)):
-        return True
-    return False
+    pool_module(pool)
+    return inventory.volume(pool, name, _volumes_of(req, pool)) is not None
 
 
 def create(req, pool, name, size):
@@ -141,7 +421,8 @@ def create(req, pool, name, size):
     # lvm/zfs will fail if we try to create a LV/dataset with a duplicate name
     if check_vol_exists(req, pool, name):
         raise TargetdError(TargetdError.NAME_CONFLICT, "Volume with that name exists")
-    mod.create(req, pool, name, size)
+    with _changing(req, pool, name):
+        mod.create(req, pool, name, size)
 
 
 def get_so_name(pool, volname):
@@ -150,167 +431,159 @@ def get_so_name(pool, volname):
 
 def destroy(req, pool, name):
     mod = pool_module(pool)
-    if not check_vol_exists(req, pool, name):
+    _volume(req, pool, name)
+
+    if _lio().block_lun(get_so_name(pool, name)) is not None:
         raise TargetdError(
-            TargetdError.NOT_FOUND_VOLUME,
-            "Volume %s not found in pool %s" % (name, pool),
+            TargetdError.VOLUME_MASKED,
+            "Volume '%s' cannot be " "removed while exported" % name,
         )
 
-    with ignored(RTSLibNotInCFS):
-        fm = FabricModule("iscsi")
-        t = Target(fm, target_name, mode="lookup")
-        tpg = TPG(t, 1, mode="lookup")
-
-        so_name = get_so_name(pool, name)
-
-        if so_name in (lun.storage_object.name for lun in tpg.luns):
-            raise TargetdError(
-                TargetdError.VOLUME_MASKED,
-                "Volume '%s' cannot be " "removed while exported" % name,
-            )
-
-    mod.destroy(req, pool, name)
+    try:
+        mod.destroy(req, pool, name)
+    except BaseException:
+        _forget_volumes(req, pool)
+        raise
+    req.forget(("volumes", pool))
+    inventory.update(pool, name, None)
 
 
 def copy(req, pool, vol_orig, vol_new, size=None, timeout=10):
     mod = pool_module(pool)
-    if not check_vol_exists(req, pool, vol_orig):
+    orig = _volume(req, pool, vol_orig)
+
+    if size is not None and orig["size"] >= size:
         raise TargetdError(
-            TargetdError.NOT_FOUND_VOLUME,
-            "Volume %s not found in pool %s" % (vol_orig, pool),
+            TargetdError.INVALID_ARGUMENT,
+            "Size %d need a larger than size in original volume %s in pool %s"
+            % (size, vol_orig, pool),
         )
 
-    if size is not None:
-        for v in mod.volumes(req, pool):
-            if v["name"] == vol_orig and v["size"] >= size:
-                raise TargetdError(
-                    TargetdError.INVALID_ARGUMENT,
-                    "Size %d need a larger than size in original volume %s in pool %s"
-                    % (size, vol_orig, pool),
-                )
+    if check_vol_exists(req, pool, vol_new):
+        raise TargetdError(TargetdError.NAME_CONFLICT, "Volume with that name exists")
 
-    mod.copy(req, pool, vol_orig, vol_new, size, timeout)
+    with _changing(req, pool, vol_new):
+        mod.copy(req, pool, vol_orig, vol_new, size, timeout)
 
 
 def resize(req, pool, name, size):
     mod = pool_module(pool)
-    if not check_vol_exists(req, pool, name):
+    if _volume(req, pool, name)["size"] >= size:
         raise TargetdError(
-            TargetdError.NOT_FOUND_VOLUME,
-            "Volume %s not found in pool %s" % (name, pool),
+            TargetdError.INVALID_ARGUMENT,
+            "Size %d need a larger than size in original volume %s in pool %s"
+            % (size, name, pool),
         )
 
-    for v in mod.volumes(req, pool):
-        if v["name"] == name and v["size"] >= size:
-            raise TargetdError(
-                TargetdError.INVALID_ARGUMENT,
-                "Size %d need a larger than size in original volume %s in pool %s"
-                % (size, name, pool),
-            )
+    with _changing(req, pool, name):
+        mod.resize(req, pool, name, size)
 
-    mod.resize(req, pool, name, size)
 
+def export_list(
+    req, initiator_wwn=None, pool=None, name_prefix=None, limit=None, marker=None
+):
+    model = _lio()
 
-def export_list(req):
-    try:
-        fm = FabricModule("iscsi")
-        t = Target(fm, target_name, mode="lookup")
-        tpg = TPG(t, 1, mode="lookup")
-    except RTSLibNotInCFS:
-        return []
-
+    # Filter and page with what the LUN mappings tell, the volumes are only
+    # looked up for the exports returned.
     exports = []
-    for na in tpg.node_acls:
-        for mlun in na.mapped_luns:
-            mod = udev_path_module(mlun.tpg_lun.storage_object.udev_path)
-            mlun_pool, mlun_name = mod.split_udev_path(
-                mlun.tpg_lun.storage_object.udev_path
-            )
-            vinfo = mod.vol_info(mod.dev2pool_name(mlun_pool), mlun_name)
-            exports.append(
-                dict(
-                    initiator_wwn=na.node_wwn,
-                    lun=mlun.mapped_lun,
-                    vol_name=mlun_name,
-                    pool=mod.dev2pool_name(mlun_pool),
-                    vol_uuid=vinfo.uuid,
-                    vol_size=vinfo.size,
-                )
-            )
-    return exports
+    # A volume is usually mapped to several initiators
+    vol_of = dict()
+    for wwn, mapped in model.mapped.items():
+        if initiator_wwn is not None and wwn != initiator_wwn:
+            continue
+        for mapped_lun, index in mapped.items():
+            udev_path = model.luns[index][2]
+            if udev_path not in vol_of:
+                mod = udev_path_module(udev_path)
+                mlun_pool, mlun_name = mod.split_udev_path(udev_path)
+                vol_of[udev_path] = (mod.dev2pool_name(mlun_pool), mlun_name)
+            pool_name, mlun_name = vol_of[udev_path]
+            if pool is not None and pool_name != pool:
+                continue
+            if name_prefix and not mlun_name.startswith(name_prefix):
+                continue
+            exports.append((wwn, mapped_lun, pool_name, mlun_name))
+
+    page = list(paginate(exports, lambda e: (e[0], e[1]), limit, marker))
+
+    # One listing per pool for all the volumes of the page, rather than a
+    # lookup per LUN
+    vols = dict()
+    for pool_name in set(e[2] for e in page):
+        vols[pool_name] = dict(
+            (v["name"], v)
+            for v in inventory.volumes(pool_name, _volumes_of(req, pool_name))
+        )
 
+    for wwn, lun, pool_name, vol_name in page:
+        vinfo = vols[pool_name].get(vol_name)
+        if vinfo is None:
+            # Created behind our back since the pool was listed
+            vinfo = vol_info(req, pool_name, vol_name)
+        yield dict(
+            initiator_wwn=wwn,
+            lun=lun,
+            vol_name=vol_name,
+            pool=pool_name,
+            vol_uuid=vinfo["uuid"],
+            vol_size=vinfo["size"],
+        )
 
-def export_create(req, pool, vol, initiator_wwn, lun):
-    fm = FabricModule("iscsi")
-    t = Target(fm, target_name)
-    tpg = TPG(t, 1)
-    tpg.enable = True
-    tpg.set_attribute("authentication", "0")
 
-    set_portal_addresses(tpg)
+def export_create(req, pool, vol, initiator_wwn, lun):
+    with _changing_lio() as model:
+        tpg = _lio_target_tpg(model)
+        tpg.enable = True
+        tpg.set_attribute("authentication", "0")
 
-    na = NodeACL(tpg, initiator_wwn)
+        set_portal_addresses(tpg)
 
-    tpg_lun = _tpg_lun_of(tpg, pool, vol)
+        na = NodeACL(tpg, initiator_wwn)
+        if initiator_wwn not in model.groups:
+            model.add_acl(initiator_wwn)
 
-    # only add mapped lun if it doesn't exist
-    for tmp_mlun in tpg_lun.mapped_luns:
-        if tmp_mlun.mapped_lun == lun and tmp_mlun.parent_nodeacl == na:
-            break
-    else:
-        MappedLUN(na, lun, tpg_lun)
+        tpg_lun = _tpg_lun_of(req, model, tpg, pool, vol)
 
-    RTSRoot().save_to_file()
+        # only add mapped lun if it doesn't exist
+        if model.mapped[initiator_wwn].get(lun) != tpg_lun.lun:
+            MappedLUN(na, lun, tpg_lun)
+            model.map(initiator_wwn, lun, tpg_lun.lun)
 
 
 def export_destroy(req, pool, vol, initiator_wwn):
-    mod = pool_module(pool)
-    fm = FabricModule("iscsi")
-    t = Target(fm, target_name)
-    tpg = TPG(t, 1)
-    na = NodeACL(tpg, initiator_wwn)
-
-    pool_dev_name = mod.pool2dev_name(pool)
-
-    for mlun in na.mapped_luns:
-        # all SOs are Block so we can access udev_path safely
-        if mod.has_udev_path(mlun.tpg_lun.storage_object.udev_path):
-            mlun_vg, mlun_name = mod.split_udev_path(
-                mlun.tpg_lun.storage_object.udev_path
-            )
-
-            if mlun_vg == pool_dev_name and mlun_name == vol:
-                tpg_lun = mlun.tpg_lun
-                mlun.delete()
-                # be tidy and delete unused tpg lun mappings?
-                if not any(tpg_lun.mapped_luns):
-                    so = tpg_lun.storage_object
-                    tpg_lun.delete()
-                    so.delete()
-                break
-    else:
+    model = _lio()
+    index = model.block_lun(get_so_name(pool, vol))
+    mapped_lun = model.mapped_lun(initiator_wwn, index)
+    if index is None or mapped_lun is None:
         raise TargetdError(
             TargetdError.NOT_FOUND_VOLUME_EXPORT,
             "Volume '%s' not found in %s exports" % (vol, initiator_wwn),
         )
 
-    # Clean up tree if branch has no leaf
-    if not any(na.mapped_luns):
-        na.delete()
-        if not any(tpg.node_acls):
-            tpg.delete()
-            if not any(t.tpgs):
-                t.delete()
-
-    RTSRoot().save_to_file()
+    with _changing_lio() as model:
+        tpg = model.tpg
+        na = NodeACL(tpg, initiator_wwn, mode="lookup")
+        MappedLUN(na, mapped_lun).delete()
+        model.unmap(initiator_wwn, mapped_lun)
+        # be tidy and delete unused tpg lun mappings?
+        if not model.is_mapped(index):
+            _remove_lun(model, index)
+
+        # Clean up tree if branch has no leaf
+        if not model.mapped[initiator_wwn]:
+            na.delete()
+            model.remove_acl(initiator_wwn)
+            if not model.groups:
+                t = tpg.parent_target
+                tpg.delete()
+                if not any(t.tpgs):
+                    t.delete()
+                # Nothing left worth keeping
+                _forget_lio()
 
 
 def initiator_set_auth(req, initiator_wwn, in_user, in_pass, out_user, out_pass):
-    fm = FabricModule("iscsi")
-    t = Target(fm, target_name)
-    tpg = TPG(t, 1)
-    na = NodeACL(tpg, initiator_wwn)
-
     if not in_user or not in_pass:
         # rtslib treats '' as its NULL value for these
         in_user = in_pass = ""
@@ -318,20 +591,23 @@ def initiator_set_auth(req, initiator_wwn, in_user, in_pass, out_user, out_pass)
     if not out_user or not out_pass:
         out_user = out_pass = ""
 
-    na.chap_userid = in_user
-    na.chap_password = in_pass
+    with _changing_lio() as model:
+        na = NodeACL(_lio_target_tpg(model), initiator_wwn)
+        if initiator_wwn not in model.groups:
+            model.add_acl(initiator_wwn)
 
-    na.chap_mutual_userid = out_user
-    na.chap_mutual_password = out_pass
+        na.chap_userid = in_user
+        na.chap_password = in_pass
 
-    RTSRoot().save_to_file()
+        na.chap_mutual_userid = out_user
+        na.chap_mutual_password = out_pass
 
 
 def block_pools(req):
     results = []
 
     for modname, mod in pool_modules.items():
-        results += mod.block_pools(req)
+        results += inventory.pool_list(mod.pools, lambda mod=mod: mod.block_pools(req))
 
     return results
 
@@ -345,9 +621,9 @@ def _get_iscsi_tpg():
 def initiator_list(req, standalone_only=False):
     """Return a list of initiator
 
-    Iterate all iSCSI rtslib-fb.NodeACL via rtslib-fb.TPG.node_acls().
+    Iterate all iSCSI NodeACLs of our model of the target, see _lio().
     Args:
-        req (TargetHandler):  Reserved for future use.
+        req (RequestContext):  The context of the call, see main.
         standalone_only (bool):
             When standalone_only is True, only return initiator which is not
             in any NodeACLGroup (NodeACL.tag is None).
@@ -365,25 +641,19 @@ def initiator_list(req, standalone_only=False):
         N/A
     """
 
-    def _condition(node_acl, _standalone_only):
-        if _standalone_only and node_acl.tag is not None:
-            return False
-        else:
-            return True
-
     return list(
-        {"init_id": node_acl.node_wwn, "init_type": "iscsi"}
-        for node_acl in _get_iscsi_tpg().node_acls
-        if _condition(node_acl, standalone_only)
+        {"init_id": wwn, "init_type": "iscsi"}
+        for wwn, group in _lio().groups.items()
+        if not standalone_only or group is None
     )
 
 
 def access_group_list(req):
     """Return a list of access group
 
-    Iterate all iSCSI rtslib-fb.NodeACLGroup via rtslib-fb.TPG.node_acls().
+    Iterate all iSCSI NodeACLGroups of our model of the target, see _lio().
     Args:
-        req (TargetHandler):  Reserved for future use.
+        req (RequestContext):  The context of the call, see main.
     Returns:
         [
             {
@@ -397,13 +667,10 @@ def access_group_list(req):
     Raises:
         N/A
     """
+    model = _lio()
     return list(
-        {
-            "name": node_acl_group.name,
-            "init_ids": list(node_acl_group.wwns),
-            "init_type": "iscsi",
-        }
-        for node_acl_group in _get_iscsi_tpg().node_acl_groups
+        {"name": name, "init_ids": model.members(name), "init_type": "iscsi"}
+        for name in model.group_names()
     )
 
 
@@ -413,78 +680,79 @@ def access_group_create(req, ag_name, init_id, init_type):
 
     name_check(ag_name)
 
-    tpg = _get_iscsi_tpg()
+    model = _lio()
 
     # Pre-check:
     #   1. Name conflict: requested name is in use
     #   2. Initiator conflict:  request initiator is in use
 
-    for node_acl_group in tpg.node_acl_groups:
-        if node_acl_group.name == ag_name:
-            raise TargetdError(
-                TargetdError.NAME_CONFLICT, "Requested access group name is in use"
-            )
+    if ag_name in model.group_names():
+        raise TargetdError(
+            TargetdError.NAME_CONFLICT, "Requested access group name is in use"
+        )
 
-    if init_id in list(i.node_wwn for i in tpg.node_acls):
+    if init_id in model.groups:
         raise TargetdError(TargetdError.EXISTS_INITIATOR, "Requested init_id is in use")
 
-    node_acl_group = NodeACLGroup(tpg, ag_name)
-    node_acl_group.add_acl(init_id)
-    RTSRoot().save_to_file()
+    with _changing_lio() as model:
+        NodeACLGroup(_lio_target_tpg(model), ag_name).add_acl(init_id)
+        model.add_acl(init_id, ag_name)
 
 
 def access_group_destroy(req, ag_name):
-    NodeACLGroup(_get_iscsi_tpg(), ag_name).delete()
-    RTSRoot().save_to_file()
+    with _changing_lio() as model:
+        NodeACLGroup(_lio_target_tpg(model), ag_name).delete()
+        for wwn in model.members(ag_name):
+            model.remove_acl(wwn)
 
 
 def access_group_init_add(req, ag_name, init_id, init_type):
     if init_type != "iscsi":
         raise TargetdError(TargetdError.NO_SUPPORT, "Only support iscsi")
 
-    tpg = _get_iscsi_tpg()
+    model = _lio()
     # Pre-check:
     #   1. Already in requested access group, return silently.
     #   2. Initiator does not exist.
     #   3. Initiator not used by other access group.
 
-    if init_id in list(NodeACLGroup(tpg, ag_name).wwns):
+    if model.groups.get(init_id) == ag_name:
         return
 
-    for node_acl_group in tpg.node_acl_groups:
-        if init_id in list(node_acl_group.wwns):
-            raise TargetdError(
-                TargetdError.EXISTS_INITIATOR,
-                "Requested init_id is used by other access group",
-            )
-    for node_acl in tpg.node_acls:
-        if init_id == node_acl.node_wwn:
-            raise TargetdError(
-                TargetdError.EXISTS_INITIATOR, "Requested init_id is in use"
-            )
+    if model.groups.get(init_id) is not None:
+        raise TargetdError(
+            TargetdError.EXISTS_INITIATOR,
+            "Requested init_id is used by other access group",
+        )
+    if init_id in model.groups:
+        raise TargetdError(TargetdError.EXISTS_INITIATOR, "Requested init_id is in use")
 
-    NodeACLGroup(tpg, ag_name).add_acl(init_id)
-    RTSRoot().save_to_file()
+    with _changing_lio() as model:
+        # The new member gets the mappings of the group
+        mapped = dict(model.group_mapped(ag_name))
+        NodeACLGroup(_lio_target_tpg(model), ag_name).add_acl(init_id)
+        model.add_acl(init_id, ag_name)
+        for mapped_lun, index in mapped.items():
+            model.map(init_id, mapped_lun, index)
 
 
 def access_group_init_del(req, ag_name, init_id, init_type):
     if init_type != "iscsi":
         raise TargetdError(TargetdError.NO_SUPPORT, "Only support iscsi")
 
-    tpg = _get_iscsi_tpg()
-
     # Pre-check:
     #   1. Initiator is not in requested access group, return silently.
-    if init_id not in list(NodeACLGroup(tpg, ag_name).wwns):
+    if _lio().groups.get(init_id) != ag_name:
         return
 
-    NodeACLGroup(tpg, ag_name).remove_acl(init_id)
-    RTSRoot().save_to_file()
+    with _changing_lio() as model:
+        NodeACLGroup(model.tpg, ag_name).remove_acl(init_id)
+        model.remove_acl(init_id)
 
 
 def access_group_map_list(req):
     """
-    Return a list of dictionaries in this format:
+    Yield dictionaries in this format:
         {
             'ag_name': ag_name,
             'h_lun_id': h_lun_id,   # host side LUN ID
@@ -492,43 +760,41 @@ def access_group_map_list(req):
             'vol_name': vol_name,
         }
     """
-    results = []
-    tpg = _get_iscsi_tpg()
+    model = _lio()
 
-    for node_acl_group in tpg.node_acl_groups:
-        for mapped_lun_group in node_acl_group.mapped_lun_groups:
-            tpg_lun = mapped_lun_group.tpg_lun
-            so_name = tpg_lun.storage_object.name
+    for ag_name in model.group_names():
+        for h_lun_id, index in model.group_mapped(ag_name).items():
+            so_name = model.luns[index][0]
             mod = so_name_module(so_name)
             pool_name, vol_name = mod.so_name2pool_volume(so_name)
 
             # When user delete old volume and the created new one with
             # idential name. The mapping status will be kept.
             # Hence we don't expose volume UUID here.
-            results.append(
-                {
-                    "ag_name": node_acl_group.name,
-                    "h_lun_id": mapped_lun_group.mapped_lun,
-                    "pool_name": pool_name,
-                    "vol_name": vol_name,
-                }
-            )
-
-    return results
+            yield {
+                "ag_name": ag_name,
+                "h_lun_id": h_lun_id,
+                "pool_name": pool_name,
+                "vol_name": vol_name,
+            }
 
 
-def _tpg_lun_of(tpg, pool_name, vol_name):
+def _tpg_lun_of(req, model, tpg, pool_name, vol_name):
     """
     Return a object of LUN for given pool and volume.
     If not exist, create one.
     """
     mod = pool_module(pool_name)
     # get wwn of volume so LIO can export as vpd83 info
-    vol_serial = mod.vol_info(pool_name, vol_name).uuid
+    vol_serial = vol_info(req, pool_name, vol_name)["uuid"]
 
-    # only add new SO if it doesn't exist
     # so.name concats pool & vol names separated by ':'
     so_name = mod.get_so_name(pool_name, vol_name)
+    index = model.block_lun(so_name)
+    if index is not None:
+        return LUN(tpg, index)
+
+    # only add new SO if it doesn't exist
     try:
         so = BlockStorageObject(so_name)
     except RTSLibError:
@@ -539,79 +805,71 @@ def _tpg_lun_of(tpg, pool_name, vol_name):
     with ignored(RTSLibError):
         so.set_attribute("emulate_model_alias", "1")
 
-    # only add tpg lun if it doesn't exist
-    for tmp_lun in tpg.luns:
-        if (
-            tmp_lun.storage_object.name == so.name
-            and tmp_lun.storage_object.plugin == "block"
-        ):
-            return tmp_lun
-    else:
-        return LUN(tpg, storage_object=so)
+    tpg_lun = LUN(tpg, storage_object=so)
+    model.add_lun(tpg_lun.lun, so.name, "block", so.udev_path)
+    return tpg_lun
 
 
 def access_group_map_create(req, pool_name, vol_name, ag_name, h_lun_id=None):
-    tpg = _get_iscsi_tpg()
-    tpg.enable = True
-    tpg.set_attribute("authentication", "0")
-
-    set_portal_addresses(tpg)
-
-    tpg_lun = _tpg_lun_of(tpg, pool_name, vol_name)
-
-    # Pre-Check:
-    #   1. Already mapped to requested access group, return None
-    if any(tpg_lun.mapped_luns):
-        tgt_map_list = access_group_map_list(req)
-        for tgt_map in tgt_map_list:
-            if (
-                tgt_map["ag_name"] == ag_name
-                and tgt_map["pool_name"] == pool_name
-                and tgt_map["vol_name"] == vol_name
-            ):
-                # Already masked.
-                return None
-
-    node_acl_group = NodeACLGroup(tpg, ag_name)
-    if not any(node_acl_group.wwns):
-        # Non-existent access group means volume mapping status will not be
-        # stored. This should be considered as an error instead of silently
-        # returning.
-        raise TargetdError(
-            TargetdError.NOT_FOUND_ACCESS_GROUP, "Access group not found"
-        )
-
-    if h_lun_id is None:
-        # Find out next available host LUN ID
-        # Assuming max host LUN ID is MAX_LUN
-        free_h_lun_ids = set(range(MAX_LUN + 1)) - set(
-            [int(x.mapped_lun) for x in tpg_lun.mapped_luns]
-        )
-        if len(free_h_lun_ids) == 0:
+    with _changing_lio() as model:
+        tpg = _lio_target_tpg(model)
+        tpg.enable = True
+        tpg.set_attribute("authentication", "0")
+
+        set_portal_addresses(tpg)
+
+        tpg_lun = _tpg_lun_of(req, model, tpg, pool_name, vol_name)
+
+        # Pre-Check:
+        #   1. Already mapped to requested access group, return None
+        if tpg_lun.lun in model.group_mapped(ag_name).values():
+            # Already masked.
+            return None
+
+        members = model.members(ag_name)
+        if not members:
+            # Non-existent access group means volume mapping status will not be
+            # stored. This should be considered as an error instead of silently
+            # returning.
             raise TargetdError(
-                TargetdError.NO_FREE_HOST_LUN_ID,
-                "All host LUN ID 0 ~ %d is in use" % MAX_LUN,
+                TargetdError.NOT_FOUND_ACCESS_GROUP, "Access group not found"
             )
-        else:
-            h_lun_id = free_h_lun_ids.pop()
 
-    node_acl_group.mapped_lun_group(h_lun_id, tpg_lun)
-    RTSRoot().save_to_file()
+        if h_lun_id is None:
+            # Find out next available host LUN ID
+            # Assuming max host LUN ID is MAX_LUN
+            free_h_lun_ids = set(range(MAX_LUN + 1)) - model.mapped_lun_ids(tpg_lun.lun)
+            if len(free_h_lun_ids) == 0:
+                raise TargetdError(
+                    TargetdError.NO_FREE_HOST_LUN_ID,
+                    "All host LUN ID 0 ~ %d is in use" % MAX_LUN,
+                )
+            else:
+                h_lun_id = free_h_lun_ids.pop()
+
+        NodeACLGroup(tpg, ag_name).mapped_lun_group(h_lun_id, tpg_lun)
+        for wwn in members:
+            model.map(wwn, h_lun_id, tpg_lun.lun)
 
 
 def access_group_map_destroy(req, pool_name, vol_name, ag_name):
-    tpg = _get_iscsi_tpg()
-    node_acl_group = NodeACLGroup(tpg, ag_name)
-    tpg_lun = _tpg_lun_of(tpg, pool_name, vol_name)
-    for map_group in node_acl_group.mapped_lun_groups:
-        if map_group.tpg_lun == tpg_lun:
-            map_group.delete()
-
-    if not any(tpg_lun.mapped_luns):
-        # If LUN is not masked to any access group or initiator
-        # remove LUN instance.
-        lun_so = tpg_lun.storage_object
-        tpg_lun.delete()
-        lun_so.delete()
+    mod = pool_module(pool_name)
+    vol_info(req, pool_name, vol_name)
+    index = _lio().block_lun(mod.get_so_name(pool_name, vol_name))
+    if index is None:
+        # Not mapped to anybody
+        return
 
-    RTSRoot().save_to_file()
+    with _changing_lio() as model:
+        for h_lun_id, i in list(model.group_mapped(ag_name).items()):
+            if i != index:
+                continue
+            for wwn in model.members(ag_name):
+                na = NodeACL(model.tpg, wwn, mode="lookup")
+                MappedLUN(na, h_lun_id).delete()
+                model.unmap(wwn, h_lun_id)
+
+        if not model.is_mapped(index):
+            # If LUN is not masked to any access group or initiator
+            # remove LUN instance.
+            _remove_lun(model, index)
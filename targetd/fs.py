@@ -16,12 +16,13 @@
 #
 # fs support using btrfs.
 
+import importlib
 import os
 
-from targetd.backends import btrfs, zfs
+from targetd import locks, stats
 from targetd.mount import Mount
 from targetd.nfs import Nfs, Export
-from targetd.utils import TargetdError
+from targetd.utils import TargetdError, paginate
 
 # Notes:
 #
@@ -40,8 +41,15 @@ from targetd.utils import TargetdError
 #
 # There may be better ways of utilizing btrfs.
 
-pool_modules = {"zfs": zfs, "btrfs": btrfs}
+# File systems we have a backend for
+fs_types = ("zfs", "btrfs")
+# Backends of the pool types configured, loaded by initialize()
+pool_modules = dict()
 allow_chown = False
+all_pools = []
+# The backend of each pool by mount point, replaced as a whole by
+# initialize()
+routes = dict()
 
 
 def pool_module(pool_name):
@@ -50,14 +58,14 @@ def pool_module(pool_name):
     :param pool_name: the pool to determine this for
     :return: the module responsible for it
     """
-    for modname, mod in pool_modules.items():
-        if mod.has_fs_pool(pool_name):
-            return mod
-    raise TargetdError(TargetdError.INVALID_POOL, "Invalid pool (%s)" % pool_name)
+    try:
+        return routes[pool_name]
+    except (KeyError, TypeError):
+        raise TargetdError(TargetdError.INVALID_POOL, "Invalid pool (%s)" % pool_name)
 
 
 def initialize(config_dict):
-    pools = {"zfs": [], "btrfs": []}
+    pools = dict((fs_type, []) for fs_type in fs_types)
     global allow_chown
 
     allow_chown = config_dict["allow_chown"]
@@ -74,7 +82,7 @@ def initialize(config_dict):
     for info in Mount.mounted_filesystems():
         if info[Mount.MOUNT_POINT] in all_fs_pools:
             filesystem = info[Mount.FS_TYPE]
-            if filesystem in pool_modules:
+            if filesystem in fs_types:
                 # forward both mountpoint and device to the backend as ZFS prefers its own devices (pool/volume) and
                 # btrfs prefers mount points (/mnt/btrfs). Otherwise ZFS or btrfs needs to ask mounted_filesystems again
                 pools[filesystem].append(
@@ -86,8 +94,27 @@ def initialize(config_dict):
                     "Unsupported filesystem {0} for pool {1}".format(info[2], info[1]),
                 )
 
+    for modname in fs_types:
+        if modname not in pool_modules:
+            if not pools[modname]:
+                continue
+            with stats.startup.step("%s import" % modname):
+                pool_modules[modname] = importlib.import_module(
+                    "targetd.backends." + modname
+                )
+        with stats.startup.step("%s fs initialize" % modname):
+            pool_modules[modname].fs_initialize(config_dict, pools[modname])
+
+    # The pools which passed their checks
+    global all_pools
+    global routes
+    mounts = dict()
     for modname, mod in pool_modules.items():
-        mod.fs_initialize(config_dict, pools[modname])
+        for p in pools[modname]:
+            if mod.has_fs_pool(p["mount"]):
+                mounts.setdefault(p["mount"], mod)
+    routes = mounts
+    all_pools = list(mounts)
 
     return dict(
         fs_list=fs,
@@ -104,6 +131,50 @@ def initialize(config_dict):
     )
 
 
+def _all_pools_locked(params):
+    # File systems and snapshots are looked up by uuid, which could be in
+    # any of the pools.
+    return [locks.fs_pool(p) for p in all_pools]
+
+
+def _pool_locked(params):
+    if "pool_name" in params:
+        return [locks.fs_pool(params["pool_name"])]
+    return _all_pools_locked(params)
+
+
+def _listed_pools_locked(params):
+    if params.get("pool") is not None:
+        return [locks.fs_pool(params["pool"])]
+    return _all_pools_locked(params)
+
+
+def _nfs_locked(params):
+    return [locks.NFS]
+
+
+# Resources each method works on, locked by main while the method runs
+lock_resources = dict(
+    fs_list=_listed_pools_locked,
+    fs_destroy=_all_pools_locked,
+    fs_create=_pool_locked,
+    fs_clone=_all_pools_locked,
+    ss_list=_all_pools_locked,
+    fs_snapshot=_all_pools_locked,
+    fs_snapshot_delete=_all_pools_locked,
+    nfs_export_auth_list=lambda params: [],
+    nfs_export_list=_nfs_locked,
+    nfs_export_add=_nfs_locked,
+    nfs_export_remove=_nfs_locked,
+)
+
+# Methods which don't change anything, they share their locks
+read_only = frozenset(["fs_list", "ss_list", "nfs_export_auth_list", "nfs_export_list"])
+
+# Methods which may take long, clients can run them as a job
+async_capable = frozenset(["fs_clone"])
+
+
 def fs_create(req, pool_name, name, size_bytes):
     """
     Create a filesystem inside a given pool with a given name
@@ -154,24 +225,46 @@ def fs_pools(req):
     return results
 
 
-def _fs_hash():
-    fs_list = {}
+def _fs_hash(req, pool=None, name_prefix=None):
+    def _list():
+        fs_list = {}
 
-    for mod in pool_modules.values():
-        fs_list.update(mod.fs_hash())
+        for mod in pool_modules.values():
+            fs_list.update(mod.fs_hash(pool, name_prefix))
 
-    return fs_list
+        return fs_list
 
+    # Looking up a filesystem by uuid lists them all, do it once per call
+    return req.memo(("fs", pool, name_prefix), _list)
 
-def fs(req):
-    return list(_fs_hash().values())
 
+def fs(req, pool=None, name_prefix=None, limit=None, marker=None):
+    if pool is not None:
+        # Fail on pools we don't have
+        pool_module(pool)
 
-def ss(req, fs_uuid, fs_cache=None):
+    yield from paginate(
+        _fs_hash(req, pool, name_prefix).values(),
+        lambda f: (f["name"], f["pool"]),
+        limit,
+        marker,
+    )
+
+
+def ss(req, fs_uuid, fs_cache=None, name_prefix=None, limit=None, marker=None):
     if fs_cache is None:
         fs_cache = _get_fs_by_uuid(req, fs_uuid)
 
-    return pool_module(fs_cache["pool"]).ss(req, fs_cache["pool"], fs_cache["name"])
+    pool, name = fs_cache["pool"], fs_cache["name"]
+    yield from paginate(
+        req.memo(
+            ("ss", pool, name, name_prefix),
+            lambda: list(pool_module(pool).ss(req, pool, name, name_prefix)),
+        ),
+        lambda s: (s["name"],),
+        limit,
+        marker,
+    )
 
 
 def _get_fs_by_uuid(req, fs_uuid):
@@ -194,7 +287,7 @@ def _get_ss_by_uuid(req, fs_uuid, ss_uuid, fs_ht=None):
 def fs_clone(req, fs_uuid, dest_fs_name, snapshot_id):
     fs_ht = _get_fs_by_uuid(req, fs_uuid)
     if snapshot_id:
-        snapshot = _get_ss_by_uuid(req, fs_uuid, snapshot_id)
+        snapshot = _get_ss_by_uuid(req, fs_uuid, snapshot_id, fs_ht)
         source = snapshot["name"]
     else:
         source = None
@@ -209,11 +302,8 @@ def nfs_export_auth_list(req):
 
 
 def nfs_export_list(req):
-    rc = []
-    exports = Nfs.exports()
-    for e in exports:
-        rc.append(dict(host=e.host, path=e.path, options=e.options_list()))
-    return rc
+    for e in Nfs.exports():
+        yield dict(host=e.host, path=e.path, options=e.options_list())
 
 
 def nfs_export_add(req, host, path, options=None, chown=None, export_path=None):
@@ -0,0 +1,100 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Results of calls made with an idempotency key, replayed when the client
+# retries the call with the same key.
+
+import json
+import time
+from collections import OrderedDict
+from threading import Event, Lock
+
+from targetd.utils import TargetdError
+
+# Longest idempotency key we accept
+MAX_KEY_LENGTH = 256
+
+
+class Reply(object):
+    def __init__(self, call):
+        self.call = call
+        self.result = None
+        self.expires = None
+        self.done = Event()
+
+
+class ReplyCache(object):
+    """
+    Keeps the result of the last `size` calls made with an idempotency key
+    for `ttl` seconds.  Only results are kept, a call which failed runs
+    again when retried.
+    """
+
+    def __init__(self, size=1024, ttl=600):
+        self.size = size
+        self.ttl = ttl
+        self.lock = Lock()
+        self.replies = OrderedDict()
+
+    def call(self, key, method, params, fn, *args):
+        """
+        Returns fn(*args), or what it returned for the call of method with
+        the same key and params before.  A retry made while the first call
+        still runs waits for it.
+        """
+        if not isinstance(key, str) or not 0 < len(key) <= MAX_KEY_LENGTH:
+            raise TargetdError(
+                TargetdError.INVALID_ARGUMENT,
+                "idempotency_key should be a string of 1 to %d characters"
+                % MAX_KEY_LENGTH,
+            )
+        # params may be changed by fn, and dicts compare fine as json
+        call = (method, json.dumps(params, sort_keys=True))
+
+        while True:
+            with self.lock:
+                reply = self.replies.get(key)
+                if reply is not None and reply.expires is not None:
+                    if reply.expires < time.monotonic():
+                        del self.replies[key]
+                        reply = None
+
+                if reply is None:
+                    reply = Reply(call)
+                    self.replies[key] = reply
+                    while len(self.replies) > self.size:
+                        self.replies.popitem(last=False)
+                    break
+
+                if reply.call != call:
+                    raise TargetdError(
+                        TargetdError.INVALID_ARGUMENT,
+                        "idempotency_key %s was used for a different call" % key,
+                    )
+                self.replies.move_to_end(key)
+
+            reply.done.wait()
+            if reply.expires is not None:
+                return reply.result
+            # The first call failed, have a go ourselves
+
+        try:
+            reply.result = fn(*args)
+            reply.expires = time.monotonic() + self.ttl
+            return reply.result
+        finally:
+            if reply.expires is None:
+                with self.lock:
+                    if self.replies.get(key) is reply:
+                        del self.replies[key]
+            reply.done.set()
@@ -0,0 +1,107 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# What we know of the volumes and sizes of the block pools, so we don't
+# list a whole pool to look up one volume.
+
+import time
+from threading import Lock
+
+
+class Inventory(object):
+    """
+    The volumes of each pool, and the pools' sizes, as last listed by their
+    backend.  The calls changing a pool update it as they go, and what is
+    older than `ttl` seconds is listed again in case the pools were changed
+    behind our back.  With a ttl of 0 nothing is kept.
+    """
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.lock = Lock()
+        # Pool name to (expiry, dict of volume name to volume)
+        self.vols = dict()
+        # Pool name to (expiry, pool as returned by pool_list)
+        self.pools = dict()
+
+    def _fresh(self, entries, key):
+        entry = entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def _by_name(self, pool, fetch):
+        with self.lock:
+            vols = self._fresh(self.vols, pool)
+        if vols is None:
+            vols = dict((v["name"], v) for v in fetch())
+            if self.ttl:
+                with self.lock:
+                    self.vols[pool] = (time.monotonic() + self.ttl, vols)
+        return vols
+
+    def volumes(self, pool, fetch):
+        """
+        Returns the volumes of pool, fetch() lists them when we don't know
+        them.
+        """
+        vols = self._by_name(pool, fetch)
+        with self.lock:
+            return list(vols.values())
+
+    def volume(self, pool, name, fetch):
+        """
+        Returns volume name of pool, None when there is none.
+        """
+        return self._by_name(pool, fetch).get(name)
+
+    def pool_list(self, names, fetch):
+        """
+        Returns the pools names, fetch() lists them when we don't know them
+        all.
+        """
+        with self.lock:
+            pools = [self._fresh(self.pools, name) for name in names]
+        if None not in pools:
+            return pools
+
+        pools = fetch()
+        if self.ttl:
+            expires = time.monotonic() + self.ttl
+            with self.lock:
+                for p in pools:
+                    self.pools[p["name"]] = (expires, p)
+        return pools
+
+    def update(self, pool, name, vol):
+        """
+        Volume name of pool changed to vol, or was removed when vol is None.
+        The size of the pool is listed again next time.
+        """
+        with self.lock:
+            self.pools.pop(pool, None)
+            vols = self._fresh(self.vols, pool)
+            if vols is None:
+                return
+            if vol is None:
+                vols.pop(name, None)
+            else:
+                vols[name] = vol
+
+    def forget(self, pool):
+        """
+        Drop what we know of pool, it is listed again next time.
+        """
+        with self.lock:
+            self.pools.pop(pool, None)
+            self.vols.pop(pool, None)
@@ -0,0 +1,160 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Background jobs for long running rpc methods.
+
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Lock
+
+from targetd.utils import TargetdError
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# Longest wait() waits, the caller holds a request worker meanwhile
+MAX_WAIT = 30
+
+
+class Job(object):
+    def __init__(self, method):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+
+    def status(self):
+        rc = dict(
+            id=self.id,
+            method=self.method,
+            state=self.state,
+            created=self.created,
+            started=self.started,
+            finished=self.finished,
+        )
+        if self.state == DONE:
+            rc["result"] = self.result
+        elif self.state == FAILED:
+            rc["error"] = dict(code=self.error[0], message=self.error[1])
+        return rc
+
+
+class JobManager(object):
+    """
+    Runs jobs on a pool of workers threads and keeps track of them.  The
+    last `history` finished jobs are kept around so clients can fetch their
+    outcome.
+    """
+
+    def __init__(self, workers=4, history=256):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.history = history
+        self.lock = Lock()
+        self.jobs = OrderedDict()
+
+    def submit(self, method, fn, *args):
+        """
+        Queue fn(*args) as a job for method, returns the job id.  fn reports
+        failures by raising TargetdError.
+        """
+        job = Job(method)
+        # Nobody can get hold of the job before it has its future
+        with self.lock:
+            job.future = self.executor.submit(self._run, job, fn, *args)
+            self.jobs[job.id] = job
+        return job.id
+
+    def _run(self, job, fn, *args):
+        job.started = time.time()
+        job.state = RUNNING
+        try:
+            job.result = fn(*args)
+            job.state = DONE
+        except TargetdError as td:
+            job.error = (td.error, str(td))
+            job.state = FAILED
+        except Exception as e:
+            job.error = (-1, "%s: %s" % (type(e).__name__, e))
+            job.state = FAILED
+        finally:
+            job.finished = time.time()
+            with self.lock:
+                self._expire()
+
+    def _expire(self):
+        finished = [j for j in self.jobs.values() if j.finished is not None]
+        for job in finished[: max(len(finished) - self.history, 0)]:
+            del self.jobs[job.id]
+
+    def _job(self, job_id):
+        with self.lock:
+            if job_id not in self.jobs:
+                raise TargetdError(
+                    TargetdError.NOT_FOUND_JOB, "Job %s not found" % job_id
+                )
+            return self.jobs[job_id]
+
+    def status(self, job_id):
+        return self._job(job_id).status()
+
+    def wait(self, job_id, timeout=MAX_WAIT):
+        """
+        Wait up to timeout seconds, MAX_WAIT at most, for the job to finish,
+        returns its status either way.
+        """
+        if (
+            not isinstance(timeout, (int, float))
+            or isinstance(timeout, bool)
+            or timeout < 0
+        ):
+            raise TargetdError(
+                TargetdError.INVALID_ARGUMENT,
+                "timeout should be a number of seconds from 0 to %d" % MAX_WAIT,
+            )
+        job = self._job(job_id)
+        wait([job.future], min(timeout, MAX_WAIT))
+        return job.status()
+
+    def drain(self, timeout=None):
+        """
+        Wait up to timeout seconds for the jobs queued and running to finish,
+        returns False when some didn't.
+        """
+        with self.lock:
+            futures = [j.future for j in self.jobs.values() if j.future is not None]
+        return not wait(futures, timeout).not_done
+
+    def list(self):
+        with self.lock:
+            return [j.status() for j in self.jobs.values()]
+
+    def cancel(self, job_id):
+        """
+        Only jobs which haven't started yet can be cancelled, returns the job
+        status so the caller can tell.
+        """
+        job = self._job(job_id)
+        if job.future is not None and job.future.cancel():
+            job.state = CANCELLED
+            job.finished = time.time()
+        return job.status()
@@ -0,0 +1,115 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# What we know of the LIO configuration of our iSCSI target, so listing
+# and checking it doesn't walk configfs.
+
+
+class Tpg(object):
+    """
+    The LUNs of the TPG of our target, the initiators allowed in (NodeACLs)
+    with their access group, and the LUNs mapped to each of them.  Read
+    from configfs by block, which applies the changes it makes to LIO here
+    too.
+    """
+
+    def __init__(self, tpg=None):
+        # The rtslib TPG, None when there is no target
+        self.tpg = tpg
+        # LUN index to (storage object name, plugin, udev path)
+        self.luns = dict()
+        # Block storage object name to LUN index
+        self.block_luns = dict()
+        # Initiator wwn to its access group, None when it has none
+        self.groups = dict()
+        # Initiator wwn to dict of mapped LUN id to LUN index
+        self.mapped = dict()
+        # LUN index to set of (initiator wwn, mapped LUN id) using it
+        self.users = dict()
+
+    def add_lun(self, index, so_name, plugin, udev_path):
+        self.luns[index] = (so_name, plugin, udev_path)
+        if plugin == "block":
+            self.block_luns[so_name] = index
+
+    def remove_lun(self, index):
+        so_name, plugin, udev_path = self.luns.pop(index)
+        if self.block_luns.get(so_name) == index:
+            del self.block_luns[so_name]
+        self.users.pop(index, None)
+
+    def block_lun(self, so_name):
+        """
+        Returns the index of the LUN of block storage object so_name, None
+        when there is none.
+        """
+        return self.block_luns.get(so_name)
+
+    def is_mapped(self, index):
+        return bool(self.users.get(index))
+
+    def add_acl(self, wwn, group=None):
+        """
+        Initiator wwn is allowed in, as a member of access group when not
+        None.  When it already was, it keeps its mappings.
+        """
+        self.groups[wwn] = group
+        self.mapped.setdefault(wwn, dict())
+
+    def remove_acl(self, wwn):
+        for mapped_lun in list(self.mapped.get(wwn, ())):
+            self.unmap(wwn, mapped_lun)
+        self.groups.pop(wwn, None)
+        self.mapped.pop(wwn, None)
+
+    def map(self, wwn, mapped_lun, index):
+        self.mapped[wwn][mapped_lun] = index
+        self.users.setdefault(index, set()).add((wwn, mapped_lun))
+
+    def unmap(self, wwn, mapped_lun):
+        index = self.mapped[wwn].pop(mapped_lun)
+        self.users[index].discard((wwn, mapped_lun))
+        if not self.users[index]:
+            del self.users[index]
+
+    def mapped_lun(self, wwn, index):
+        """
+        Returns the id LUN index is mapped as to initiator wwn, None when it
+        isn't.
+        """
+        for mapped_lun, i in self.mapped.get(wwn, dict()).items():
+            if i == index:
+                return mapped_lun
+        return None
+
+    def mapped_lun_ids(self, index):
+        """
+        Returns the ids LUN index is mapped as, to any initiator.
+        """
+        return set(mapped_lun for wwn, mapped_lun in self.users.get(index, ()))
+
+    def group_names(self):
+        return list(dict.fromkeys(g for g in self.groups.values() if g is not None))
+
+    def members(self, group):
+        return [wwn for wwn, g in self.groups.items() if g == group]
+
+    def group_mapped(self, group):
+        """
+        Returns the dict of mapped LUN id to LUN index of access group, as
+        LIO does: those of its first member.
+        """
+        members = self.members(group)
+        if not members:
+            return dict()
+        return self.mapped[members[0]]
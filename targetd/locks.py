@@ -0,0 +1,117 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Locking of the resources rpc methods work on.
+
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+# The LIO target (TPG, LUNs, ACLs ...) and the NFS export table are each
+# one resource, pools are one resource each.
+LIO = "lio"
+NFS = "nfs"
+
+# Taken shared by every call, and exclusive for calls which need everything
+# or when requests are serialized.
+GLOBAL = "global"
+
+
+def block_pool(pool_name):
+    return "block:%s" % pool_name
+
+
+def fs_pool(pool_name):
+    return "fs:%s" % pool_name
+
+
+class RWLock(object):
+    """
+    Lock which is held either by any number of readers or by one writer.
+    Waiting writers go first, so a steady flow of readers can't starve them.
+    """
+
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    def acquire(self, shared=False):
+        with self.cond:
+            if shared:
+                while self.writer or self.writers_waiting:
+                    self.cond.wait()
+                self.readers += 1
+            else:
+                self.writers_waiting += 1
+                while self.writer or self.readers:
+                    self.cond.wait()
+                self.writers_waiting -= 1
+                self.writer = True
+
+    def release(self, shared=False):
+        with self.cond:
+            if shared:
+                self.readers -= 1
+            else:
+                self.writer = False
+            self.cond.notify_all()
+
+
+class LockManager(object):
+    """
+    Hands out one lock per resource name.  A call locks all the resources it
+    touches, always in sorted order, so two calls can never wait on each
+    other while holding a lock the other one needs.  Calls which only read
+    share the locks, calls making changes hold them exclusively.
+
+    Every call also holds the GLOBAL lock shared, so a call can lock
+    everything by taking it exclusively.  With serialize set every call
+    does that, which is how targetd used to process requests.
+    """
+
+    def __init__(self, serialize=False):
+        self.serialize = serialize
+        self.lock = Lock()
+        self.locks = dict()
+
+    def _lock_of(self, resource):
+        with self.lock:
+            if resource not in self.locks:
+                self.locks[resource] = RWLock()
+            return self.locks[resource]
+
+    @contextmanager
+    def _held(self, resources):
+        # resources is a list of (name, shared) in locking order
+        held = []
+        try:
+            for resource, shared in resources:
+                lock = self._lock_of(resource)
+                lock.acquire(shared)
+                held.append((lock, shared))
+            yield
+        finally:
+            for lock, shared in reversed(held):
+                lock.release(shared)
+
+    def locked(self, resources, shared=False):
+        if self.serialize:
+            return self.locked_all()
+
+        return self._held(
+            [(GLOBAL, True)] + [(r, shared) for r in sorted(set(resources))]
+        )
+
+    def locked_all(self):
+        return self._held([(GLOBAL, False)])
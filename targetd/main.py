@@ -17,9 +17,15 @@
 # sharable resources on the local machine, such as the LIO
 # kernel target.
 
+import contextlib
+import grp
 import json
 import os
 import signal
+import socketserver
+import struct
+import subprocess
+import sys
 
 import setproctitle
 
@@ -32,12 +38,20 @@ import itertools
 import socket
 import base64
 import ssl
-from socketserver import ThreadingMixIn
+import queue
+import selectors
 import time
-from threading import Lock
+from collections import OrderedDict, deque
+from threading import Event, Lock, Thread
 import traceback
+import types
+import zlib
 import logging as log
-from targetd.utils import TargetdError, Pit, Tar
+from targetd.utils import TargetdError, Pit, Tar, ignored
+from targetd import locks, stats
+from targetd.idempotency import ReplyCache
+from targetd.jobs import JobManager, MAX_WAIT
+from targetd.stats import MethodStats, metrics_service
 import stat
 
 default_config_path = "/etc/target/targetd.yaml"
@@ -54,8 +68,35 @@ default_config = dict(
     ssl=False,
     ssl_cert="/etc/target/targetd_cert.pem",
     ssl_key="/etc/target/targetd_key.pem",
+    ssl_min_version="TLSv1_2",
+    # AEAD suites first, TLS 1.3 suites are all AEAD and not set from here
+    ssl_ciphers="ECDHE+AESGCM:ECDHE+CHACHA20:DHE+AESGCM:DHE+CHACHA20:"
+    "HIGH:-aNULL:-eNULL:-PSK",
+    ssl_session_tickets=2,
     portal_addresses=["0.0.0.0"],
     allow_chown=False,
+    keepalive_timeout=15,
+    keepalive_max_requests=100,
+    serialize_requests=False,
+    server_engine="threading",
+    worker_threads=16,
+    request_queue_depth=64,
+    busy_retry_after=1,
+    pool_check_workers=8,
+    idempotency_cache_size=1024,
+    idempotency_ttl=600,
+    job_workers=4,
+    job_history=256,
+    metrics_address="",
+    slow_request_threshold=5,
+    compression=True,
+    compression_min_size=1024,
+    inventory_ttl=30,
+    unix_socket="",
+    unix_socket_mode=0o600,
+    unix_socket_group="",
+    unix_socket_uids=[],
+    drain_timeout=30,
 )
 
 config = {}
@@ -63,33 +104,128 @@ config = {}
 # Will be added to by fs/block.initialize()
 mapping = dict()
 
-# Used to serialize the work we actually do
-mutex = Lock()
+# Resources locked while running each method of mapping, a function of the
+# method params returning the resource names, see targetd.locks
+lock_resources = dict()
+
+# Methods of mapping which don't change anything
+read_only = set()
+
+# Methods of mapping which can run as a job when called with "async": true
+async_capable = set()
+
+# Background jobs, created by update_mapping()
+jobs = None
+
+# Results of calls made with an idempotency key, created by update_mapping()
+replies = None
+
+# Used to serialize the work we do on each resource
+lock_manager = locks.LockManager()
 
 # Tarpit
 tar = Tar()
 
+# Largest request body we accept, after authentication this really should
+# never be hit in normal operation.
+MAX_CONTENT_LENGTH = 1024 * 128
+
+# Streamed responses are sent in chunks of at least this size
+STREAM_CHUNK_SIZE = 1024 * 16
+
+# Marks the end of a streamed result
+_END = object()
+
+# TLS handshakes done by new connections, reported by stats_get
+tls_handshakes = dict(full=0, resumed=0)
+tls_handshakes_lock = Lock()
+
+# Calls, errors and timings of each method, reported by stats_get
+method_stats = MethodStats()
+
+# The running server, its stats() are reported by stats_get
+service = None
+
 
 class TargetHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 lets clients keep the connection (and the TLS session) open
+    # across requests, every response must then carry a Content-Length.
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        # Idle timeout for a persistent connection, applied to the socket
+        # by StreamRequestHandler.setup()
+        self.timeout = config["keepalive_timeout"] or None
+        self.requests_served = 0
+        BaseHTTPRequestHandler.setup(self)
+
+        # The handshake was completed by accept(), just account for it
+        if isinstance(self.request, ssl.SSLSocket):
+            count_handshake(self.request)
+
+    def handle(self):
+        # One request per turn on a worker, between requests a persistent
+        # connection waits without one, see WorkerPoolMixIn.park()
+        self.close_connection = True
+        self.handle_one_request()
+
+    def handle_next(self):
+        """
+        Serve the next request of our persistent connection.
+        """
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    def handle_one_request(self):
+        if self.requests_served and self.server.draining.is_set():
+            # Draining, persistent connections close between requests
+            self.close_connection = True
+            return
+        BaseHTTPRequestHandler.handle_one_request(self)
+
+    def finish(self):
+        # A persistent connection stays open for its next request
+        if self.close_connection:
+            BaseHTTPRequestHandler.finish(self)
+
+    def pending(self):
+        """
+        Whether the client sent (some of) its next request already, it may
+        be buffered by rfile or TLS where the socket doesn't show it.
+        """
+        self.request.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except ssl.SSLWantReadError:
+            return False
+        except OSError:
+            # Reading it tells what went wrong
+            return True
+        finally:
+            self.request.settimeout(self.timeout)
+
     def log_request(self, code="-", size="-"):
         # override base class - don't log good requests
         pass
 
-    def do_POST(self):
+    def log_message(self, format, *args):
+        # Idle persistent connections timing out are routine, send the base
+        # class messages to the log instead of stderr.
+        log.debug("%s - %s" % (self.address_string(), format % args))
 
-        rpcdata = ""
-        error = None
-        id_num = 0
-
-        # get basic auth string, strip "Basic "
+    def authorize(self):
+        """
+        Check the credentials sent with the request, returns False when the
+        request was answered with an error.
+        """
         try:
-            auth_bytes = self.headers.get("Authorization")[6:].encode("utf-8")
-            auth_str = base64.b64decode(auth_bytes).decode("utf-8")
-            in_user, in_pass = auth_str.split(":")
+            in_user, in_pass = credentials(self.headers)
         except Exception:
             log.error(traceback.format_exc())
             self.send_error(400)
-            return
+            return False
 
         if tar.is_stuck(self.client_address[0]):
             log.warning(
@@ -98,13 +234,28 @@ class TargetHandler(BaseHTTPRequestHandler):
             # This client already has a failed authentication attempt,
             # immediately return error without trying new credentials.
             self.send_error(503)
-            return
+            return False
+
+        if not authenticated(in_user, in_pass):
+            # Tarpit the bad authentication for a bit.  The 401 is sent by
+            # the tarpit timer, this worker moves on to other connections.
+            client = self.client_address[0]
+            self.server.detach(self.request)
+            self.close_connection = True
+            tar.hold(
+                client,
+                tar.failed(client),
+                self.server.answer,
+                self.request,
+                unauthorized_response(),
+            )
+            return False
+
+        return True
+
+    def do_POST(self):
 
-        if in_user != config["user"] or in_pass != config["password"]:
-            # Tarpit the bad authentication for a bit
-            with tar.pitted(self.client_address[0]):
-                time.sleep(2)
-                self.send_error(401)
+        if not self.authorize():
             return
 
         if not self.path == "/targetrpc":
@@ -120,7 +271,7 @@ class TargetHandler(BaseHTTPRequestHandler):
                 # Make sure we aren't being asked to read too much data.
                 # Since this happens after authentication this really should
                 # never happen for normal operation.
-                if content_len > (1024 * 128):
+                if content_len > MAX_CONTENT_LENGTH:
                     log.error(
                         "client %s, content-length = %d rejecting!"
                         % (self.client_address[0], content_len)
@@ -133,73 +284,955 @@ class TargetHandler(BaseHTTPRequestHandler):
                 # see http://www.jsonrpc.org/specification for errcodes
                 error = (-32700, "parse error")
                 raise
+        except:
+            log.debug(traceback.format_exc())
+            log.debug("Error=%s, msg=%s" % (error[0], error[1]))
+            self.wfile.write(json.dumps(rpc_error(error, 0)).encode("utf-8"))
+            # No HTTP framing was sent, the connection can't be reused.
+            self.close_connection = True
+            return
+
+        # Chunked encoding needs HTTP/1.1
+        headers, rpcdata = http_response(
+            rpc_response(self, req, self.request_version != "HTTP/1.0"),
+            self.headers.get("Accept-Encoding"),
+        )
 
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
+        self.requests_served += 1
+        self.send_response(200)
+        for name, value in headers:
+            self.send_header(name, str(value))
+        if (
+            not config["keepalive_timeout"]
+            or self.requests_served >= config["keepalive_max_requests"]
+            or self.server.draining.is_set()
+        ):
+            # send_header() also marks the connection to be closed
+            self.send_header("Connection", "close")
+        self.end_headers()
+
+        if isinstance(rpcdata, bytes):
+            self.wfile.write(rpcdata)
+            return
+
+        try:
+            for chunk in rpcdata:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        except Exception as e:
+            # Too late for an error response, the missing last chunk tells
+            # the client the response is incomplete.
+            log.error("Streaming response failed: %s" % e)
+            log.debug(traceback.format_exc())
+            self.close_connection = True
+        finally:
+            rpcdata.close()
+
+
+class LocalTargetHandler(TargetHandler):
+    """
+    Handles the requests of local clients, connected to the unix_socket.
+    """
+
+    def authorize(self):
+        # No password, the socket permissions and the uid of the client
+        # decide
+        if local_authorized(self.client_address[2]):
+            return True
+
+        log.warning("Refusing local client %s" % (self.client_address,))
+        self.send_error(403)
+        return False
+
+
+def credentials(headers):
+    """
+    Returns the user and password of the basic auth header, raises on a
+    missing or malformed header.
+    """
+    # get basic auth string, strip "Basic "
+    auth_bytes = headers.get("Authorization")[6:].encode("utf-8")
+    auth_str = base64.b64decode(auth_bytes).decode("utf-8")
+    in_user, in_pass = auth_str.split(":")
+    return in_user, in_pass
+
+
+def peer_address(sock):
+    """
+    The address of the local client at the other end of sock, a unix
+    socket, in place of the (host, port) of TCP clients: "local:<uid>",
+    its pid and its uid.
+    """
+    pid, uid, gid = struct.unpack(
+        "3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, 12)
+    )
+    return "local:%d" % uid, pid, uid
+
+
+def local_authorized(uid):
+    return not config["unix_socket_uids"] or uid in config["unix_socket_uids"]
+
+
+def unix_socket(path):
+    """
+    Returns a unix socket bound to path, with the permissions set in the
+    config, to listen on.  A socket left over by a previous run is
+    replaced.
+    """
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        # Nobody can connect before we listen
+        os.chmod(path, config["unix_socket_mode"])
+        if config["unix_socket_group"]:
+            os.chown(path, -1, grp.getgrnam(config["unix_socket_group"]).gr_gid)
+    except (OSError, KeyError):
+        sock.close()
+        raise
+    return sock
+
+
+def tcp_socket(address):
+    """
+    Returns a TCP socket bound to address and listening, set up as the
+    threading engine's HTTPServer does it.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(socket.SOMAXCONN)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def remove_unix_socket(sock, path):
+    if sock is not None:
+        # Closed already when served by the asyncio engine, closing is harmless
+        sock.close()
+        if path:
+            with ignored(OSError):
+                os.unlink(path)
+
+
+# The sockets we listen on, as passed on to another process
+SOCKET_NAMES = ("api", "local", "metrics")
+
+# First file descriptor passed by systemd, see sd_listen_fds(3)
+SD_LISTEN_FDS_START = 3
+
+
+def inherited_sockets():
+    """
+    Returns the listening sockets passed to us, by name, and whether they
+    come from systemd socket activation.  Sockets are also passed on by the
+    targetd we take over from, see handover().  systemd sockets without a
+    FileDescriptorName of SOCKET_NAMES are told apart by their family.
+    """
+    fds = []
+    activated = os.environ.get("LISTEN_PID") == str(os.getpid())
+    if activated:
+        count = int(os.environ.get("LISTEN_FDS", "0"))
+        names = os.environ.get("LISTEN_FDNAMES", "").split(":")
+        names += [""] * count
+        for i in range(count):
+            fds.append((SD_LISTEN_FDS_START + i, names[i]))
+    elif os.environ.get("TARGETD_LISTEN_FDS"):
+        for entry in os.environ["TARGETD_LISTEN_FDS"].split(","):
+            name, fd = entry.split("=")
+            fds.append((int(fd), name))
+    # Not for our children
+    for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES", "TARGETD_LISTEN_FDS"):
+        os.environ.pop(name, None)
+
+    sockets = dict()
+    for fd, name in fds:
+        sock = socket.socket(fileno=fd)
+        if name not in SOCKET_NAMES:
+            name = "local" if sock.family == socket.AF_UNIX else "api"
+        if name in sockets:
+            log.warning("Ignoring a second %s socket passed to us" % name)
+            sock.close()
+            continue
+        sockets[name] = sock
+    return sockets, activated
+
+
+# The targetd we last handed over to, see handover()
+successor = None
+
+
+def handover(sockets):
+    """
+    Start a new targetd, passing it sockets, a dict of name to listening
+    socket.  Once it serves them it sends us SIGTERM, see took_over().
+    Returns whether it was started.
+    """
+    global successor
+
+    fds = dict((name, sock.fileno()) for name, sock in sockets.items())
+    env = dict(
+        os.environ,
+        TARGETD_LISTEN_FDS=",".join("%s=%d" % item for item in fds.items()),
+        TARGETD_HANDOVER_PID=str(os.getpid()),
+    )
+    try:
+        child = subprocess.Popen(
+            [sys.executable] + sys.argv, env=env, pass_fds=list(fds.values())
+        )
+    except (OSError, ValueError) as e:
+        log.error("Can't start a new targetd: %s" % e)
+        return False
+    log.info("Handing over to targetd %d" % child.pid)
+    successor = child
+    Thread(target=_handover_failed, args=(child,), name="handover", daemon=True).start()
+    return True
 
-            try:
-                version = req["jsonrpc"]
-                if version != "2.0":
-                    raise ValueError
-                method = req["method"]
-                id_num = int(req["id"])
-                params = req.get("params", None)
-            except (KeyError, ValueError):
-                error = (-32600, "not a valid jsonrpc-2.0 request")
-                raise
 
-            # Serialize the actual work to be done.
-            mutex.acquire()
+def _handover_failed(child):
+    rc = child.wait()
+    if RUN:
+        log.error("Handover failed, the new targetd exited with %d" % rc)
+
+
+def handed_over():
+    """
+    Whether the targetd we handed over to is still running, it serves our
+    sockets then.
+    """
+    return successor is not None and successor.returncode is None
+
+
+def sd_notify(state):
+    """
+    Send state to systemd, see sd_notify(3).  Does nothing when systemd
+    didn't ask for it.
+    """
+    path = os.environ.get("NOTIFY_SOCKET")
+    if not path:
+        return
+    if path.startswith("@"):
+        # Abstract socket
+        path = "\0" + path[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(state.encode("utf-8"), path)
+    except OSError as e:
+        log.error("Can't notify systemd: %s" % e)
+    finally:
+        sock.close()
+
+
+def notify_successor():
+    """
+    Once we stop serving for the targetd we handed over to, make it the main
+    process of our systemd service, or systemd stops it when we exit.
+    """
+    if handed_over():
+        sd_notify("MAINPID=%d" % successor.pid)
+
+
+def took_over():
+    """
+    Tell the targetd we took over from, if any, to stop.  It finishes the
+    calls it has in progress, ours wait for it to exit as our locks don't
+    cover its calls.
+    """
+    pid = os.environ.pop("TARGETD_HANDOVER_PID", None)
+    if pid is None:
+        return
+
+    pid = int(pid)
+    locked = Event()
+    Thread(
+        target=_locked_until_exit, args=(pid, locked), name="handover", daemon=True
+    ).start()
+    locked.wait()
+    os.kill(pid, signal.SIGTERM)
+
+
+def _locked_until_exit(pid, locked):
+    with lock_manager.locked_all():
+        locked.set()
+        # It started us, we are handed to init once it exited
+        while os.getppid() == pid:
+            time.sleep(0.1)
+        log.info("targetd %d exited, serving calls" % pid)
+
+
+def authenticated(in_user, in_pass):
+    return in_user == config["user"] and in_pass == config["password"]
+
+
+def count_handshake(ssl_object):
+    with tls_handshakes_lock:
+        if ssl_object.session_reused:
+            tls_handshakes["resumed"] += 1
+        else:
+            tls_handshakes["full"] += 1
+
+
+def rpc_response(req, rpc, stream=False):
+    """
+    Runs the decoded jsonrpc-2.0 request, or batch of requests, and returns
+    the encoded response.  With stream set, the response to a single call of
+    a method yielding its result is returned as a generator of encoded
+    chunks instead, see _streamed_response().
+    """
+    # A jsonrpc-2.0 batch is an array of request objects, each one is
+    # processed on its own and answered in order.
+    if isinstance(rpc, list) and len(rpc):
+        return b"[" + b", ".join(_rpc_call(req, r) for r in rpc) + b"]"
+
+    return _rpc_call(req, rpc, stream)
+
+
+def http_response(rpcdata, accept_encoding=None):
+    """
+    Returns the headers and the body of the HTTP response carrying rpcdata,
+    as returned by rpc_response().  The body is compressed when the client
+    accepts it and it isn't too small.  It is bytes, or when rpcdata is
+    streamed a generator of the chunks to send with chunked encoding.
+    """
+    headers = [("Content-type", "application/json")]
+
+    coding = None
+    if config["compression"]:
+        headers.append(("Vary", "Accept-Encoding"))
+        # Streamed responses are larger than any sensible threshold
+        if not isinstance(rpcdata, bytes) or (
+            len(rpcdata) >= config["compression_min_size"]
+        ):
+            coding = content_coding(accept_encoding)
+
+    if coding is not None:
+        headers.append(("Content-Encoding", coding))
+        if isinstance(rpcdata, bytes):
+            compressor = zlib.compressobj(wbits=_WBITS[coding])
+            rpcdata = compressor.compress(rpcdata) + compressor.flush()
+        else:
+            rpcdata = _compressed(rpcdata, coding)
+
+    if isinstance(rpcdata, bytes):
+        headers.append(("Content-Length", len(rpcdata)))
+    else:
+        headers.append(("Transfer-Encoding", "chunked"))
+    return headers, rpcdata
+
+
+# zlib window bits selecting the gzip and the zlib ("deflate" in HTTP) format
+_WBITS = dict(gzip=16 + zlib.MAX_WBITS, deflate=zlib.MAX_WBITS)
+
+
+def content_coding(accept_encoding):
+    """
+    Returns the compression, gzip or deflate, to use for a client sending
+    this Accept-Encoding header, None for none.
+    """
+    accepted = dict()
+    for coding in (accept_encoding or "").split(","):
+        name, _, params = coding.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name.strip().lower()] = q
+
+    for coding in ("gzip", "deflate"):
+        if accepted.get(coding, accepted.get("*", 0.0)) > 0:
+            return coding
+    return None
+
+
+def _compressed(chunks, coding):
+    compressor = zlib.compressobj(wbits=_WBITS[coding])
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            # An empty chunk would end the response
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        chunks.close()
+
+
+def rpc_error(error, id_num):
+    return dict(
+        error=dict(code=error[0], message=error[1]),
+        id=id_num,
+        jsonrpc="2.0",
+    )
+
+
+def _rpc_call(req, rpc, stream=False):
+    """
+    Process a single jsonrpc-2.0 request object and return the encoded
+    response object, which carries either the result or the error.
+    """
+    error = (-1, "jsonrpc error")
+    id_num = 0
+    method = None
+
+    try:
+        try:
+            version = rpc["jsonrpc"]
+            if version != "2.0":
+                raise ValueError
+            method = rpc["method"]
+            id_num = int(rpc["id"])
+            params = rpc.get("params", None)
+        except (KeyError, ValueError, TypeError, AttributeError):
+            error = (-32600, "not a valid jsonrpc-2.0 request")
+            raise
+
+        try:
+            key = None
+            if isinstance(params, dict):
+                key = params.pop("idempotency_key", None)
+
+            if key is not None and method not in read_only:
+                # Retries with the same key get the result of the first call
+                result = replies.call(key, method, params, _run, req, method, params)
+            else:
+                result = _run(req, method, params, stream)
+                if isinstance(result, types.GeneratorType):
+                    chunks = _streamed_response(result, id_num, method)
+                    # Failing before the first chunk is complete is still
+                    # answered with a jsonrpc error, after that it's too late.
+                    first = next(chunks)
+                    if len(first) < STREAM_CHUNK_SIZE:
+                        # That was all of it
+                        return first + b"".join(chunks)
+                    return _prepended(first, chunks)
+        except TargetdError as td:
+            error = (td.error, str(td))
+            raise
+
+        response = dict(result=result, id=id_num, jsonrpc="2.0")
+    except:
+        log.debug(traceback.format_exc())
+        log.debug("Error=%s, msg=%s" % (error[0], error[1]))
+        response = rpc_error(error, id_num)
+
+    data = json.dumps(response).encode("utf-8")
+    if method in mapping:
+        method_stats.response(method, len(data))
+    return data
+
+
+def _run(req, method, params, stream=False):
+    if (
+        method in async_capable
+        and isinstance(params, dict)
+        and params.pop("async", False)
+    ):
+        # Run it in the background, the client polls for the outcome
+        return jobs.submit(method, _invoke, req, method, params)
+    return _invoke(req, method, params, stream)
+
+
+def _streamed_response(items, id_num, method):
+    """
+    Encodes the response to a call whose result is streamed, yielding it
+    in chunks of at least STREAM_CHUNK_SIZE bytes as the items come in.
+    Only the last chunk is smaller.
+    """
+
+    def parts():
+        yield b'{"result": ['
+        separator = b""
+        for item in items:
+            yield separator + json.dumps(item).encode("utf-8")
+            separator = b", "
+        yield ('], "id": %d, "jsonrpc": "2.0"}' % id_num).encode("utf-8")
+
+    size = 0
+    chunk = []
+    chunk_size = 0
+    try:
+        for part in parts():
+            chunk.append(part)
+            chunk_size += len(part)
+            if chunk_size >= STREAM_CHUNK_SIZE:
+                yield b"".join(chunk)
+                size += chunk_size
+                chunk = []
+                chunk_size = 0
+        yield b"".join(chunk)
+        size += chunk_size
+    finally:
+        items.close()
+
+    method_stats.response(method, size)
+
+
+def _prepended(first, chunks):
+    try:
+        yield first
+        yield from chunks
+    finally:
+        chunks.close()
+
+
+class RequestContext(object):
+    """
+    Passed to the rpc methods as their req argument, for one call.  Besides
+    the client_address and headers of the HTTP request it came with, it
+    keeps what the backends looked up for the call, see memo().  That is
+    only valid while the call holds its locks.
+    """
+
+    def __init__(self, request):
+        # The handler, or the aioserver Request
+        self.request = request
+        self.memos = dict()
+
+    @property
+    def client_address(self):
+        return self.request.client_address
+
+    @property
+    def headers(self):
+        return self.request.headers
+
+    def memo(self, key, fn, *args):
+        """
+        Returns fn(*args), only called the first time for key.
+        """
+        if key not in self.memos:
+            self.memos[key] = fn(*args)
+        return self.memos[key]
+
+    def forget(self, key):
+        """
+        Drop the memo of key, after the call changed what it looked up.
+        """
+        self.memos.pop(key, None)
+
+
+class _Call(object):
+    """
+    A call of method, holding the resources it works on locked until it is
+    done, and accounting for it.
+    """
+
+    def __init__(self, method, params):
+        self.method = method
+        self.commands = stats.CallCommands()
+        self.finished = False
+
+        start = time.monotonic()
+        # Serialize the actual work done on the resources of this call.
+        self.locks = contextlib.ExitStack()
+        self.locks.enter_context(_locked(method, params))
+        self.locked = time.monotonic()
+        self.lock_wait = self.locked - start
+
+    @contextlib.contextmanager
+    def running(self):
+        """
+        Context running (part of) the method.  The commands it runs are
+        accounted to the call, failures end the call and are all raised as
+        TargetdError.
+        """
+        with stats.call_commands(self.commands):
             try:
-                if params:
-                    result = mapping[method](self, **params)
-                else:
-                    result = mapping[method](self)
-            except KeyError:
-                error = (-32601, "method %s not found" % method)
-                log.debug(traceback.format_exc())
-                raise
-            except TypeError:
-                error = (TargetdError.INVALID_ARGUMENT, "invalid method arguments(s)")
-                log.debug(traceback.format_exc())
-                raise
+                yield
             except TargetdError as td:
-                error = (td.error, str(td))
+                self.done(td.error)
                 raise
             except Exception as e:
-                error = (-1, "%s: %s" % (type(e).__name__, e))
                 log.debug(traceback.format_exc())
-                raise
-            finally:
-                mutex.release()
+                if isinstance(e, KeyError):
+                    td = TargetdError(-32601, "method %s not found" % self.method)
+                elif isinstance(e, TypeError):
+                    td = TargetdError(
+                        TargetdError.INVALID_ARGUMENT, "invalid method arguments(s)"
+                    )
+                else:
+                    td = TargetdError(-1, "%s: %s" % (type(e).__name__, e))
+                self.done(td.error)
+                raise td
+
+    def streamed(self, items):
+        """
+        Yields the items of the generator the method returned, the call is
+        done once it is exhausted or closed.
+        """
+        try:
+            while True:
+                with self.running():
+                    item = next(items, _END)
+                if item is _END:
+                    break
+                yield item
+        finally:
+            items.close()
+            self.done()
 
-            rpcdata = json.dumps(dict(result=result, id=id_num, jsonrpc="2.0"))
-        except:
-            log.debug(traceback.format_exc())
-            log.debug("Error=%s, msg=%s" % (error[0], error[1]))
-            rpcdata = json.dumps(
-                dict(
-                    error=dict(code=error[0], message=error[1]),
-                    id=id_num,
-                    jsonrpc="2.0",
-                )
+    def done(self, error_code=None):
+        if self.finished:
+            return
+        self.finished = True
+        self.locks.close()
+
+        if self.method in mapping:
+            _account(
+                self.method,
+                self.lock_wait,
+                time.monotonic() - self.locked,
+                error_code,
+                self.commands,
             )
-        finally:
-            self.wfile.write(rpcdata.encode("utf-8"))
 
 
-class HTTPService(ThreadingMixIn, HTTPServer, object):
+def _invoke(req, method, params, stream=False):
     """
-    Handle rpc requests concurrently, but process them sequentially by using a
-    mutex.  We do this so we hopefully don't block valid API users when some
-    one tries to brute force the password.
+    Call method with the resources it works on locked.  Failures are all
+    raised as TargetdError.
+
+    Methods listing things may yield their result.  With stream set it is
+    returned as a generator which keeps the resources locked until it is
+    exhausted or closed, otherwise as a list.
+    """
+    call = _Call(method, params)
+    req = RequestContext(req)
+    with call.running():
+        if params:
+            result = mapping[method](req, **params)
+        else:
+            result = mapping[method](req)
+
+        if isinstance(result, types.GeneratorType):
+            if stream:
+                return call.streamed(result)
+            result = list(result)
+
+    call.done()
+    return result
+
+
+def _account(method, lock_wait, duration, error_code, commands):
+    method_stats.call(method, lock_wait, duration, error_code, commands)
+
+    threshold = config["slow_request_threshold"]
+    if threshold and lock_wait + duration >= threshold:
+        log.warning(
+            "Slow call of %s: %.3fs, %.3fs waiting for locks, %d commands "
+            "(%d retries) in %.3fs%s"
+            % (
+                method,
+                lock_wait + duration,
+                lock_wait,
+                commands.count,
+                commands.retries,
+                commands.seconds,
+                ": " + commands.summary() if commands.count else "",
+            )
+        )
+
+
+def _locked(method, params):
+    """
+    Context manager locking the resources method works on, shared when it
+    only reads them.  Methods we know nothing about lock everything, methods
+    whose resources are None lock nothing at all.
+    """
+    if method not in mapping:
+        return lock_manager.locked([])
+
+    if method not in lock_resources:
+        return lock_manager.locked_all()
+
+    if not isinstance(params, dict):
+        params = {}
+
+    resources = lock_resources[method](params)
+    if resources is None:
+        return contextlib.nullcontext()
+
+    return lock_manager.locked(resources, shared=method in read_only)
+
+
+def busy_response():
+    return (
+        "HTTP/1.1 503 Service Unavailable\r\n"
+        "Retry-After: %d\r\n"
+        "Content-Length: 0\r\n"
+        "Connection: close\r\n\r\n" % config["busy_retry_after"]
+    ).encode("latin-1")
+
+
+def unauthorized_response():
+    return (
+        "HTTP/1.1 401 Unauthorized\r\n"
+        "Content-Length: 0\r\n"
+        "Connection: close\r\n\r\n"
+    ).encode("latin-1")
+
+
+class WorkerPoolMixIn(object):
+    """
+    Serve connections with a fixed pool of worker_threads threads.  Accepted
+    connections wait for a worker in a queue of request_queue_depth entries,
+    when it is full new connections are turned away with a 503 right away
+    instead of piling up.  A worker serves one request at a time, persistent
+    connections wait for their next one in the idle watcher, then queue up
+    for a worker again.
+    """
+
+    # Another WorkerPoolMixIn server whose workers serve ours too
+    shared_with = None
+
+    # Connections arriving while we restart wait in the listen backlog
+    request_queue_size = socket.SOMAXCONN
+
+    def server_activate(self):
+        super(WorkerPoolMixIn, self).server_activate()
+
+        self.rejected = 0
+        # Connections handed over by their handler, not closed by the worker
+        self.detached = set()
+        if self.shared_with is not None:
+            self.queue = self.shared_with.queue
+            self.workers = self.shared_with.workers
+            self.idle = self.shared_with.idle
+            self.draining = self.shared_with.draining
+            return
+
+        self.queue = queue.Queue(config["request_queue_depth"])
+        # Persistent connections waiting for their next request, handler to
+        # (server, when it times out), oldest first
+        self.idle = OrderedDict()
+        # Handlers parked by the workers, for the idle watcher to pick up
+        # when woken
+        self.parking = deque()
+        self.wakeup, self.woken = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.draining = Event()
+        self.workers = []
+        for _ in range(config["worker_threads"]):
+            # Workers wait for the queue forever, they must not hold up exit
+            worker = Thread(target=self._worker, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        Thread(target=self._watch_idle, name="idle", daemon=True).start()
+
+    def process_request(self, request, client_address):
+        try:
+            self.queue.put_nowait((self, request, client_address, None))
+        except queue.Full:
+            self.rejected += 1
+            log.warning("Busy, turning away connection from %s" % (client_address,))
+            self.answer(request, busy_response())
+
+    def answer(self, request, response):
+        """
+        Send response, a complete HTTP response, and close the connection.
+        Nothing here blocks, as the accept loop and the tarpit timer call it
+        for every client: one not reading its socket loses its answer.
+        """
+        try:
+            request.setblocking(False)
+            request.send(response)
+            # Read what we can of the request, closing a socket with unread
+            # data resets the connection and the client may miss the answer
+            request.recv(MAX_CONTENT_LENGTH)
+        except (OSError, ValueError):
+            pass
+        self.shutdown_request(request)
+
+    def detach(self, request):
+        """
+        Take the connection of request away from the worker handling it, the
+        caller closes it.
+        """
+        self.detached.add(request)
+
+    def adopt(self, sock):
+        """
+        Serve sock, a socket bound already, in place of our own.
+        """
+        self.socket.close()
+        self.socket = sock
+        self.server_address = sock.getsockname()
+        self.server_activate()
+
+    def park(self, server, handler):
+        """
+        Have the idle watcher wait for the next request of the persistent
+        connection of handler, which server accepted, so no worker does.
+        """
+        self.parking.append((server, handler))
+        self._wake()
+
+    def _wake(self):
+        # A full socket buffer has the watcher woken already
+        with ignored(OSError):
+            self.wakeup.send(b"\0")
+
+    def drain(self, timeout):
+        """
+        Once we stopped accepting connections, finish the requests in
+        progress and those queued.  Persistent connections are closed after
+        their current request, idle ones right away.  Returns False when
+        they took longer than timeout seconds.
+        """
+        self.draining.set()
+        self._wake()
+
+        deadline = time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _worker(self):
+        while True:
+            # handler is None for a new connection
+            server, request, client_address, handler = self.queue.get()
+            try:
+                if handler is None:
+                    handler = server.RequestHandlerClass(
+                        request, client_address, server
+                    )
+                else:
+                    handler.handle_next()
+                # Pipelined requests are served right away
+                while not handler.close_connection and handler.pending():
+                    handler.handle_next()
+            except Exception:
+                server.handle_error(request, client_address)
+                handler = None
+            finally:
+                if request in server.detached:
+                    server.detached.discard(request)
+                elif handler is not None and not handler.close_connection:
+                    self.park(server, handler)
+                else:
+                    server.shutdown_request(request)
+                self.queue.task_done()
+
+    def _watch_idle(self):
+        """
+        Hand persistent connections back to the workers once their next
+        request arrives, close them when it doesn't within their timeout or
+        when we drain.
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self.woken, selectors.EVENT_READ)
+        while True:
+            timeout = None
+            if self.idle:
+                _, deadline = next(iter(self.idle.values()))
+                timeout = max(deadline - time.monotonic(), 0)
+            for key, _ in selector.select(timeout):
+                if key.fileobj is self.woken:
+                    self.woken.recv(4096)
+                    continue
+                handler = key.data
+                selector.unregister(handler.request)
+                server, _ = self.idle.pop(handler)
+                if self.draining.is_set():
+                    self._close(server, handler)
+                else:
+                    self._resume(server, handler)
+
+            while self.parking:
+                server, handler = self.parking.popleft()
+                if self.draining.is_set():
+                    self._close(server, handler)
+                    continue
+                try:
+                    selector.register(handler.request, selectors.EVENT_READ, handler)
+                except (OSError, ValueError):
+                    self._close(server, handler)
+                    continue
+                deadline = time.monotonic() + (handler.timeout or 0)
+                self.idle[handler] = (server, deadline)
+
+            now = time.monotonic()
+            for handler, (server, deadline) in list(self.idle.items()):
+                if deadline > now and not self.draining.is_set():
+                    break
+                selector.unregister(handler.request)
+                del self.idle[handler]
+                self._close(server, handler)
+
+    def _resume(self, server, handler):
+        request = handler.request
+        try:
+            self.queue.put_nowait((server, request, handler.client_address, handler))
+        except queue.Full:
+            server.rejected += 1
+            log.warning(
+                "Busy, turning away request from %s" % (handler.client_address,)
+            )
+            self._close(server, handler, busy_response())
+
+    @staticmethod
+    def _close(server, handler, response=None):
+        handler.close_connection = True
+        with ignored(OSError, ValueError):
+            handler.finish()
+        if response is None:
+            server.shutdown_request(handler.request)
+        else:
+            server.answer(handler.request, response)
+
+    def stats(self):
+        return dict(
+            workers=len(self.workers),
+            queue_depth=self.queue.qsize(),
+            queue_limit=self.queue.maxsize,
+            rejected=self.rejected,
+        )
+
+
+class HTTPService(WorkerPoolMixIn, HTTPServer, object):
+    """
+    Handle rpc requests concurrently, but process the requests working on the
+    same resource sequentially by using a lock per resource.  We do this so
+    we hopefully don't block valid API users when some one tries to brute
+    force the password, and so calls on unrelated pools don't wait on each
+    other.
 
     Note: Many things we are calling into are not thread safe and/or cannot be
-    done concurrently.  We will process things one at a time.
+    done concurrently.  We will process things on a resource one at a time.
     """
 
 
+class UnixHTTPService(WorkerPoolMixIn, socketserver.UnixStreamServer, object):
+    """
+    Serve local clients on sock, a bound unix socket, with the workers of
+    shared_with.
+    """
+
+    def __init__(self, sock, handler, shared_with):
+        self.shared_with = shared_with
+        socketserver.UnixStreamServer.__init__(
+            self, sock.getsockname(), handler, bind_and_activate=False
+        )
+        self.adopt(sock)
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+        return request, peer_address(request)
+
+
 class TLSHTTPService(HTTPService):
     """Also use TLS to encrypt the connection"""
 
@@ -235,94 +1268,388 @@ class TLSHTTPService(HTTPService):
         ) and TLSHTTPService._verify_ssl_file(config["ssl_cert"])
 
 
-def load_config(config_path):
-    global config
-
+def read_config(config_path):
+    """
+    Returns the config in config_path, completed with the defaults, without
+    applying it.  Raises AttributeError, logged, when it isn't valid.
+    """
+    new = {}
     if os.path.isfile(config_path):
-        config = yaml.safe_load(open(config_path).read())
+        new = yaml.safe_load(open(config_path).read())
         # If a user supplies a password as "password:whatever" we don't get
         # a parse failure, we simply get a string with the contents.
         # Maybe there is a better way to handle this issue where we don't
         # have a space between key and value?
-        if config is None or type(config) is str:
-            config = {}
+        if new is None or type(new) is str:
+            new = {}
+        if not isinstance(new, dict):
+            log.critical(
+                "%s should hold settings, in the form 'name: value'" % config_path
+            )
+            raise AttributeError
 
     for key, value in iter(default_config.items()):
-        if key not in config:
-            config[key] = value
+        if key not in new:
+            new[key] = value
 
     # compatibility: handle old single-pool config option
-    if "pool_name" in config:
+    if "pool_name" in new:
         log.warning("Please update config file, " "'pool_name' should be 'block_pools'")
-        config["block_pools"] = [config["pool_name"]]
-        del config["pool_name"]
+        new["block_pools"] = [new["pool_name"]]
+        del new["pool_name"]
 
     # Make unique pool lists
-    config["block_pools"] = set(config["block_pools"])
-    config["fs_pools"] = set(config["fs_pools"])
-    config["zfs_block_pools"] = set(config["zfs_block_pools"])
+    for key in ("block_pools", "fs_pools", "zfs_block_pools"):
+        try:
+            new[key] = set(new[key])
+        except TypeError:
+            log.critical("%s in %s should be a list of pools" % (key, config_path))
+            raise AttributeError
 
-    passwd = config.get("password", None)
+    passwd = new.get("password", None)
     if not passwd or type(passwd) is not str:
         log.critical(
             "password not set in %s in the form 'password: string_pw'" % config_path
         )
         raise AttributeError
 
+    try:
+        _tls_version(new["ssl_min_version"])
+    except AttributeError:
+        log.critical(
+            "ssl_min_version '%s' is not a valid TLS version in %s"
+            % (new["ssl_min_version"], config_path)
+        )
+        raise
+
+    if new["server_engine"] not in ("threading", "asyncio"):
+        log.critical(
+            "server_engine '%s' in %s should be threading or asyncio"
+            % (new["server_engine"], config_path)
+        )
+        raise AttributeError
+
     # convert log level to int
-    config["log_level"] = getattr(log, config["log_level"].upper(), log.INFO)
+    new["log_level"] = getattr(log, str(new["log_level"]).upper(), log.INFO)
+    return new
+
+
+def apply_config():
+    lock_manager.serialize = bool(config["serialize_requests"])
+
     log.basicConfig(level=config["log_level"])
+    # basicConfig() only does anything the first time, on startup
+    log.getLogger().setLevel(config["log_level"])
+
+
+def load_config(config_path):
+    global config
+
+    config = read_config(config_path)
+    apply_config()
+
+
+# Settings of the listener and the thread pools, a config reload leaves
+# them alone
+RESTART_ONLY = (
+    "ssl",
+    "ssl_cert",
+    "ssl_key",
+    "ssl_min_version",
+    "ssl_ciphers",
+    "ssl_session_tickets",
+    "server_engine",
+    "worker_threads",
+    "request_queue_depth",
+    "job_workers",
+    "job_history",
+    "metrics_address",
+    "idempotency_cache_size",
+    "idempotency_ttl",
+    "unix_socket",
+    "unix_socket_mode",
+    "unix_socket_group",
+)
+
+
+def reload_config(config_path=None):
+    """
+    Load the config again and apply it, waiting for the calls running to
+    finish and holding up new ones meanwhile.  Only the pools added are
+    checked, and the pools removed are dropped, the others are left alone.
+    Returns the names of the pools added and removed.
+    """
+    global config
+
+    if config_path is None:
+        config_path = default_config_path
+
+    with lock_manager.locked_all():
+        try:
+            new = read_config(config_path)
+        except Exception as e:
+            raise TargetdError(
+                TargetdError.INVALID,
+                "Can't load %s, keeping the current config: %s" % (config_path, e),
+            )
+
+        for key in RESTART_ONLY:
+            if new[key] != config[key]:
+                log.warning("%s changed, it only takes effect on restart" % key)
+                new[key] = config[key]
+
+        before = _pool_names()
+        previous = config
+        restore = _saved_state()
+        config = new
+        try:
+            stats.startup = stats.Timings()
+            update_mapping()
+        except Exception as e:
+            config = previous
+            restore()
+            raise TargetdError(
+                TargetdError.INVALID,
+                "Can't apply %s, keeping the current config: %s" % (config_path, e),
+            )
+        apply_config()
+        log.info("config reloaded in %s", stats.startup)
+
+        after = _pool_names()
+        return dict(added=sorted(after - before), removed=sorted(before - after))
+
+
+def _saved_state():
+    """
+    Saves what update_mapping() changes, returns the function putting it
+    back.
+    """
+    tables = (mapping, lock_resources, read_only, async_capable)
+    saved_tables = [t.copy() for t in tables]
+    # The pool modules replace their globals rather than change them
+    modules = [
+        m
+        for name, m in list(sys.modules.items())
+        if name in ("targetd.block", "targetd.fs")
+        or name.startswith("targetd.backends.")
+    ]
+    saved_modules = [(m, dict(vars(m))) for m in modules]
+
+    def restore():
+        for table, saved in zip(tables, saved_tables):
+            table.clear()
+            table.update(saved)
+        for m, saved in saved_modules:
+            vars(m).update(saved)
+
+    return restore
+
+
+def _pool_names():
+    names = set()
+    for name in ("targetd.block", "targetd.fs"):
+        if name in sys.modules:
+            names.update(sys.modules[name].all_pools)
+    return names
 
 
 def update_mapping():
-    # wait until now so submodules can import 'main' safely
-    import targetd.block as block
-    import targetd.fs as fs
+    global jobs
+    global replies
+
+    # wait until now so submodules can import 'main' safely.  The block
+    # module needs rtslib, don't load it unless there are block pools, or
+    # were before a config reload.
+    block = sys.modules.get("targetd.block")
+    if block is None and (config["block_pools"] or config["zfs_block_pools"]):
+        with stats.startup.step("block import"):
+            import targetd.block as block
+
+    if block is not None:
+        try:
+            mapping.update(block.initialize(config))
+            lock_resources.update(block.lock_resources)
+            read_only.update(block.read_only)
+            async_capable.update(block.async_capable)
+        except Exception as e:
+            log.error("Error initializing block module: %s" % e)
+            raise
+    else:
+        log.info("No block pools configured, block methods are disabled")
 
-    try:
-        mapping.update(block.initialize(config))
-    except Exception as e:
-        log.error("Error initializing block module: %s" % e)
-        raise
+    with stats.startup.step("fs import"):
+        import targetd.fs as fs
 
     try:
         mapping.update(fs.initialize(config))
+        lock_resources.update(fs.lock_resources)
+        read_only.update(fs.read_only)
+        async_capable.update(fs.async_capable)
     except Exception as e:
         log.error("Error initializing fs module: %s" % e)
         raise
 
     # one method requires output from both modules
     def pool_list(req):
+        if block is None:
+            return fs.fs_pools(req)
         return list(itertools.chain(block.block_pools(req), fs.fs_pools(req)))
 
+    def pool_list_locked(params):
+        block_pools = block.all_pools if block is not None else []
+        return [locks.block_pool(p) for p in block_pools] + [
+            locks.fs_pool(p) for p in fs.all_pools
+        ]
+
     mapping["pool_list"] = pool_list
+    lock_resources["pool_list"] = pool_list_locked
+    mapping["stats_get"] = stats_get
+    lock_resources["stats_get"] = lambda params: []
+    read_only.update(["pool_list", "stats_get"])
+    mapping["config_reload"] = config_reload
+    # Takes all the locks itself
+    lock_resources["config_reload"] = lambda params: None
+
+    if jobs is None:
+        jobs = JobManager(config["job_workers"], config["job_history"])
+    if replies is None:
+        replies = ReplyCache(
+            config["idempotency_cache_size"], config["idempotency_ttl"]
+        )
+    for name, fn in (
+        ("job_status", job_status),
+        ("job_wait", job_wait),
+        ("job_list", job_list),
+        ("job_cancel", job_cancel),
+    ):
+        mapping[name] = fn
+        # Jobs take their own locks, waiting for one must not hold any
+        lock_resources[name] = lambda params: None
+
+
+def stats_get(req):
+    with tls_handshakes_lock:
+        tls = dict(
+            handshakes_full=tls_handshakes["full"],
+            handshakes_resumed=tls_handshakes["resumed"],
+        )
+    result = dict(
+        tls=tls, methods=method_stats.snapshot(), commands=stats.commands.snapshot()
+    )
+    if service is not None:
+        result["server"] = service.stats()
+    return result
+
+
+def config_reload(req):
+    return reload_config()
+
+
+def job_status(req, job_id):
+    return jobs.status(job_id)
+
+
+def job_wait(req, job_id, timeout=MAX_WAIT):
+    return jobs.wait(job_id, timeout)
+
+
+def job_list(req):
+    return jobs.list()
+
+
+def job_cancel(req, job_id):
+    return jobs.cancel(job_id)
 
 
 RUN = True
+RELOAD = False
+HANDOVER = False
 
 
 def handler(signum, frame):
     global RUN
-    if signum == signal.SIGINT:
-        log.info("SIGINT received, shutting down ...")
+    global RELOAD
+    global HANDOVER
+    if signum in (signal.SIGINT, signal.SIGTERM):
+        log.info("%s received, shutting down ..." % signal.Signals(signum).name)
         RUN = False
+    elif signum == signal.SIGHUP:
+        log.info("SIGHUP received, reloading config ...")
+        RELOAD = True
+    elif signum == signal.SIGUSR2:
+        log.info("SIGUSR2 received, handing over to a new targetd ...")
+        HANDOVER = True
 
 
-def wrap_socket(s):
+def reload_logged():
+    """
+    reload_config() for SIGHUP, there is nobody to return an error to.
+    """
+    try:
+        result = reload_config()
+    except Exception as e:
+        log.error("Config reload failed: %s" % e)
+        return
+    log.info(
+        "Pools added: %s, removed: %s"
+        % (", ".join(result["added"]) or "none", ", ".join(result["removed"]) or "none")
+    )
+
+
+def _tls_version(name):
+    # Accept both "TLSv1_2" and "TLSv1.2"
+    return getattr(ssl.TLSVersion, str(name).replace(".", "_"))
+
+
+def ssl_context():
     context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     context.check_hostname = False
     context.load_cert_chain(config["ssl_cert"], config["ssl_key"])
-    context.set_ciphers("HIGH:-aNULL:-eNULL:-PSK")
-    wrapped = context.wrap_socket(s, server_side=True)
+    # The newest version both sides support is negotiated, TLS 1.3 when the
+    # client offers it.
+    context.minimum_version = _tls_version(config["ssl_min_version"])
+    # Pick from our cipher ordering, not the client's
+    context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+    context.set_ciphers(config["ssl_ciphers"])
+    # Let clients that reconnect resume their session instead of doing a full
+    # handshake.  TLS 1.2 clients can also resume through the session cache
+    # OpenSSL keeps for the context.
+    # num_tickets needs Python 3.8, older ones always send one ticket
+    if config["ssl_session_tickets"]:
+        if hasattr(context, "num_tickets"):
+            context.num_tickets = config["ssl_session_tickets"]
+    else:
+        context.options |= ssl.OP_NO_TICKET
+        if hasattr(context, "num_tickets"):
+            context.num_tickets = 0
+    return context
+
+
+def wrap_socket(s):
+    wrapped = ssl_context().wrap_socket(s, server_side=True)
     return wrapped
 
 
+def drain_jobs(deadline):
+    """
+    Wait for the jobs queued and running to finish, until deadline, a
+    time.monotonic() value.
+    """
+    if jobs is not None and not jobs.drain(max(deadline - time.monotonic(), 0)):
+        log.warning("Jobs still running after drain_timeout, exiting anyway")
+
+
 def main():
+    global service
+    global RELOAD
+    global HANDOVER
 
-    signal.signal(signal.SIGINT, handler)
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGUSR2):
+        signal.signal(signum, handler)
 
     try:
-        load_config(default_config_path)
+        with stats.startup.step("config"):
+            load_config(default_config_path)
     except AttributeError:
         return -1
 
@@ -346,17 +1673,110 @@ def main():
         server_class = HTTPService
         note = "(TLS no)"
 
-    server = server_class(("", 18700), TargetHandler)
+    sockets, activated = inherited_sockets()
+    if sockets:
+        log.info(
+            "listening on sockets passed by %s: %s"
+            % ("systemd" if activated else "targetd", ", ".join(sorted(sockets)))
+        )
+
+    metrics = None
+    if "metrics" in sockets and not config["metrics_address"]:
+        sockets.pop("metrics").close()
+    if config["metrics_address"]:
+        try:
+            metrics = metrics_service(
+                config["metrics_address"],
+                lambda: stats_get(None),
+                sockets.get("metrics"),
+            )
+        except (OSError, ValueError) as e:
+            log.error(
+                "Can't serve metrics on '%s': %s" % (config["metrics_address"], e)
+            )
+            return -1
+        log.info("serving metrics on %s", config["metrics_address"])
+        sockets["metrics"] = metrics.socket
+
+    if "local" not in sockets and config["unix_socket"]:
+        try:
+            sockets["local"] = unix_socket(config["unix_socket"])
+        except (OSError, KeyError) as e:
+            log.error("Can't serve on '%s': %s" % (config["unix_socket"], e))
+            return -1
+    # The socket file is ours to remove on exit, unless systemd made it
+    local_path = None
+    if "local" in sockets:
+        if not activated:
+            local_path = sockets["local"].getsockname()
+        log.info("serving local clients on %s", sockets["local"].getsockname())
+
+    log.info("startup took %s", stats.startup)
+
+    if config["server_engine"] == "asyncio":
+        # Only import what the selected engine needs
+        from targetd.aioserver import AsyncService
+
+        if "api" not in sockets:
+            try:
+                sockets["api"] = tcp_socket(("", 18700))
+            except OSError as e:
+                log.error("Can't serve on port 18700: %s" % e)
+                return -1
+
+        server = AsyncService(sockets, ssl_context() if config["ssl"] else None)
+        service = server
+        log.info("started server %s (asyncio)", note)
+        server.serve_forever()
+        remove_unix_socket(sockets.get("local"), None if handed_over() else local_path)
+        return 0
+
+    if "api" in sockets:
+        server = server_class(("", 18700), TargetHandler, bind_and_activate=False)
+        server.adopt(sockets["api"])
+    else:
+        server = server_class(("", 18700), TargetHandler)
+        sockets["api"] = server.socket
 
     if config["ssl"]:
+        # Wrapping detaches the plain socket, hand over the wrapped one
         server.socket = wrap_socket(server.socket)
+        sockets["api"] = server.socket
+
+    service = server
+
+    local_server = None
+    if "local" in sockets:
+        # Local clients get the same workers as the others
+        local_server = UnixHTTPService(sockets["local"], LocalTargetHandler, server)
+        Thread(target=local_server.serve_forever, name="local", daemon=True).start()
 
     log.info("started server %s", note)
+    took_over()
 
     server.timeout = 0.5
     while RUN:
         server.handle_request()
-
+        if RELOAD:
+            RELOAD = False
+            # Waits for the calls running, keep accepting meanwhile
+            Thread(target=reload_logged, name="reload").start()
+        if HANDOVER:
+            HANDOVER = False
+            handover(sockets)
+
+    # Stop accepting, connections wait in the backlog for whoever serves
+    # the sockets next
+    if local_server is not None:
+        local_server.shutdown()
     server.socket.close()
+    notify_successor()
+
+    deadline = time.monotonic() + config["drain_timeout"]
+    if not server.drain(config["drain_timeout"]):
+        log.warning("Calls still in progress after drain_timeout, exiting anyway")
+    drain_jobs(deadline)
+
+    remove_unix_socket(sockets.get("local"), None if handed_over() else local_path)
 
     return 0
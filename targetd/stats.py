@@ -0,0 +1,442 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Statistics of the rpc methods, and the optional metrics endpoint
+# exposing them in the Prometheus text format.
+
+import logging as log
+import os
+import socket
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Lock, Thread, local
+
+# Upper bounds, in seconds, of the buckets of the call duration histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        # Cumulative counts, the last bucket has no upper bound
+        buckets = []
+        total = 0
+        for le, count in zip(BUCKETS + (None,), self.counts):
+            total += count
+            buckets.append([le, total])
+        return dict(count=self.count, sum=self.sum, buckets=buckets)
+
+
+class Method(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = dict()
+        self.lock_wait = 0.0
+        self.duration = Histogram()
+        self.response_bytes = 0
+        self.commands = 0
+        self.command_seconds = 0.0
+
+    def snapshot(self):
+        return dict(
+            calls=self.calls,
+            errors=dict((str(code), n) for code, n in self.errors.items()),
+            lock_wait=self.lock_wait,
+            duration=self.duration.snapshot(),
+            response_bytes=self.response_bytes,
+            commands=self.commands,
+            command_seconds=self.command_seconds,
+        )
+
+
+class MethodStats(object):
+    """
+    Counts calls and errors, and sums up the time spent waiting for locks,
+    running and the size of the responses, for each rpc method.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.methods = dict()
+
+    def _method(self, name):
+        if name not in self.methods:
+            self.methods[name] = Method()
+        return self.methods[name]
+
+    def call(self, name, lock_wait, duration, error_code=None, commands=None):
+        with self.lock:
+            m = self._method(name)
+            m.calls += 1
+            if error_code is not None:
+                m.errors[error_code] = m.errors.get(error_code, 0) + 1
+            m.lock_wait += lock_wait
+            m.duration.observe(duration)
+            if commands is not None:
+                m.commands += commands.count
+                m.command_seconds += commands.seconds
+
+    def response(self, name, size):
+        with self.lock:
+            self._method(name).response_bytes += size
+
+    def snapshot(self):
+        with self.lock:
+            return dict((name, m.snapshot()) for name, m in self.methods.items())
+
+
+# Commands whose first argument is a group of subcommands
+_COMMAND_GROUPS = frozenset(["subvolume", "qgroup", "quota", "filesystem"])
+
+
+def command_name(cmd):
+    """
+    Name commands are accounted under, the program and its subcommand, like
+    "zfs list" or "btrfs subvolume create".
+    """
+    words = [os.path.basename(cmd[0])]
+    for arg in cmd[1:3]:
+        if arg.startswith("-"):
+            break
+        words.append(arg)
+        if arg not in _COMMAND_GROUPS:
+            break
+    return " ".join(words)
+
+
+class Command(object):
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.stdout_bytes = 0
+
+    def snapshot(self):
+        return dict(
+            count=self.count,
+            failures=self.failures,
+            retries=self.retries,
+            seconds=self.seconds,
+            stdout_bytes=self.stdout_bytes,
+        )
+
+
+class CommandStats(object):
+    """
+    Counts the commands run, how many exited non-zero or were run again by
+    a retry loop, and sums up their wall time and output, by command name.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.commands = dict()
+
+    def _command(self, name):
+        if name not in self.commands:
+            self.commands[name] = Command()
+        return self.commands[name]
+
+    def ran(self, name, seconds, exit_code, stdout_bytes):
+        with self.lock:
+            c = self._command(name)
+            c.count += 1
+            if exit_code != 0:
+                c.failures += 1
+            c.seconds += seconds
+            c.stdout_bytes += stdout_bytes
+
+    def retried(self, name):
+        with self.lock:
+            self._command(name).retries += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict((name, c.snapshot()) for name, c in self.commands.items())
+
+
+class CallCommands(object):
+    """
+    The commands run on behalf of one rpc call.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.retries = 0
+        self.by_name = dict()
+
+    def ran(self, name, seconds):
+        self.count += 1
+        self.seconds += seconds
+        count, total = self.by_name.get(name, (0, 0.0))
+        self.by_name[name] = (count + 1, total + seconds)
+
+    def summary(self):
+        # Most expensive first, like "zfs get: 12 in 1.520s"
+        return ", ".join(
+            "%s: %d in %.3fs" % (name, count, total)
+            for name, (count, total) in sorted(
+                self.by_name.items(), key=lambda i: i[1][1], reverse=True
+            )
+        )
+
+
+# All commands run by the daemon, and those of the call each thread runs
+commands = CommandStats()
+_current = local()
+
+
+@contextmanager
+def call_commands(call=None):
+    """
+    Collects the commands this thread runs inside the context in call, or
+    in a new CallCommands, which it yields.
+    """
+    previous = getattr(_current, "call", None)
+    _current.call = call if call is not None else CallCommands()
+    try:
+        yield _current.call
+    finally:
+        _current.call = previous
+
+
+def command_ran(cmd, seconds, exit_code, stdout_bytes):
+    name = command_name(cmd)
+    commands.ran(name, seconds, exit_code, stdout_bytes)
+    call = getattr(_current, "call", None)
+    if call is not None:
+        call.ran(name, seconds)
+
+
+def command_retried(cmd):
+    commands.retried(command_name(cmd))
+    call = getattr(_current, "call", None)
+    if call is not None:
+        call.retries += 1
+
+
+class Timings(object):
+    """
+    Wall time of the steps of a process, in the order they ran.
+    """
+
+    def __init__(self):
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.monotonic() - start))
+
+    def __str__(self):
+        return ", ".join("%s %.3fs" % s for s in self.steps)
+
+
+# Steps of the daemon startup, logged once it serves
+startup = Timings()
+
+
+def _labels(**labels):
+    return "{%s}" % ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in sorted(labels.items())
+    )
+
+
+def prometheus(stats):
+    """
+    Renders the result of the stats_get method in the Prometheus text
+    exposition format.
+    """
+    lines = []
+
+    def metric(name, kind, text, samples):
+        lines.append("# HELP targetd_%s %s" % (name, text))
+        lines.append("# TYPE targetd_%s %s" % (name, kind))
+        for suffix, labels, value in samples:
+            lines.append("targetd_%s%s%s %s" % (name, suffix, labels, value))
+
+    methods = sorted(stats.get("methods", dict()).items())
+    metric(
+        "rpc_calls_total",
+        "counter",
+        "Calls of each rpc method.",
+        [("", _labels(method=n), m["calls"]) for n, m in methods],
+    )
+    metric(
+        "rpc_errors_total",
+        "counter",
+        "Calls of each rpc method which failed, by error code.",
+        [
+            ("", _labels(method=n, code=code), count)
+            for n, m in methods
+            for code, count in sorted(m["errors"].items())
+        ],
+    )
+    metric(
+        "rpc_lock_wait_seconds_total",
+        "counter",
+        "Time calls of each rpc method waited for their locks.",
+        [("", _labels(method=n), m["lock_wait"]) for n, m in methods],
+    )
+    duration = []
+    for n, m in methods:
+        for le, count in m["duration"]["buckets"]:
+            le = "+Inf" if le is None else le
+            duration.append(("_bucket", _labels(method=n, le=le), count))
+        duration.append(("_sum", _labels(method=n), m["duration"]["sum"]))
+        duration.append(("_count", _labels(method=n), m["duration"]["count"]))
+    metric(
+        "rpc_duration_seconds",
+        "histogram",
+        "Time calls of each rpc method ran, once they held their locks.",
+        duration,
+    )
+    metric(
+        "rpc_response_bytes_total",
+        "counter",
+        "Size of the responses of each rpc method.",
+        [("", _labels(method=n), m["response_bytes"]) for n, m in methods],
+    )
+
+    metric(
+        "rpc_command_seconds_total",
+        "counter",
+        "Time commands run by calls of each rpc method took.",
+        [("", _labels(method=n), m["command_seconds"]) for n, m in methods],
+    )
+    metric(
+        "rpc_commands_total",
+        "counter",
+        "Commands run by calls of each rpc method.",
+        [("", _labels(method=n), m["commands"]) for n, m in methods],
+    )
+
+    cmds = sorted(stats.get("commands", dict()).items())
+    for key, name, text in (
+        ("count", "commands_total", "Commands run."),
+        ("failures", "command_failures_total", "Commands which exited non-zero."),
+        ("retries", "command_retries_total", "Commands run again after failing."),
+        ("seconds", "command_seconds_total", "Time commands took."),
+        ("stdout_bytes", "command_stdout_bytes_total", "Output of commands."),
+    ):
+        metric(
+            name, "counter", text, [("", _labels(command=n), c[key]) for n, c in cmds]
+        )
+
+    tls = stats.get("tls")
+    if tls:
+        metric(
+            "tls_handshakes_total",
+            "counter",
+            "TLS connections accepted, by kind of handshake.",
+            [
+                ("", _labels(kind="full"), tls["handshakes_full"]),
+                ("", _labels(kind="resumed"), tls["handshakes_resumed"]),
+            ],
+        )
+
+    server = stats.get("server")
+    if server:
+        for name, kind, text in (
+            ("workers", "gauge", "Worker threads running rpc calls."),
+            ("queue_depth", "gauge", "Requests waiting for a worker."),
+            ("queue_limit", "gauge", "Requests which may wait for a worker."),
+            ("rejected", "counter", "Requests turned away as the server was busy."),
+        ):
+            suffix = "_total" if kind == "counter" else ""
+            metric("server_%s%s" % (name, suffix), kind, text, [("", "", server[name])])
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_request(self, code="-", size="-"):
+        # override base class - don't log good requests
+        pass
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s" % (self.address_string(), format % args))
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = prometheus(self.server.collect()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(HTTPServer):
+    def __init__(self, address, family=socket.AF_INET, bind_and_activate=True):
+        self.address_family = family
+        HTTPServer.__init__(self, address, MetricsHandler, bind_and_activate)
+
+
+def split_address(address):
+    """
+    Returns the host and port of address, "host:port", or "[host]:port" for
+    an IPv6 host.  Raises ValueError when it isn't one.
+    """
+    host, colon, port = address.rpartition(":")
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+    elif "[" in host or "]" in host:
+        raise ValueError("brackets around IPv6 hosts must be balanced")
+    if not colon:
+        raise ValueError("no port")
+    return host, int(port)
+
+
+def metrics_service(address, collect, sock=None):
+    """
+    Serve GET /metrics on address, "host:port" or "[host]:port", from a
+    thread of its own.
+    collect returns the statistics to serve, like stats_get.  There is no
+    authentication, only bind it where the scraper alone can reach it.
+    sock, a listening socket, is served instead of binding address.
+    """
+    if sock is not None:
+        server = MetricsServer(sock.getsockname()[:2], sock.family, False)
+        server.socket.close()
+        server.socket = sock
+    else:
+        host, port = split_address(address)
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        server = MetricsServer((host, port), family)
+    server.collect = collect
+    t = Thread(target=server.serve_forever, name="metrics")
+    t.daemon = True
+    t.start()
+    return server
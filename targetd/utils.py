@@ -15,10 +15,18 @@
 #
 # Utility functions.
 
+import heapq
+import itertools
+import logging as log
 import re
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from subprocess import Popen, PIPE
-from threading import Lock
+from threading import Condition, Lock, Thread
+
+from targetd import stats
 
 
 @contextmanager
@@ -40,6 +48,45 @@ def name_check(name):
         )
 
 
+def paginate(items, key, limit=None, marker=None):
+    """
+    Returns a page of items, sorted by key(item), a tuple: the first limit
+    of them whose key sorts after marker.  marker is the key of the last
+    item of the previous page as a list, or its first member alone to skip
+    all the items starting with it.  Without limit or marker the items are
+    all returned as they come, unsorted.
+    """
+    if limit is not None and (
+        not isinstance(limit, int) or isinstance(limit, bool) or limit < 1
+    ):
+        raise TargetdError(
+            TargetdError.INVALID_ARGUMENT, "limit should be a positive integer"
+        )
+    if limit is None and marker is None:
+        return items
+
+    if marker is None:
+        keyed = [(key(item), item) for item in items]
+    else:
+        marker = tuple(marker) if isinstance(marker, list) else (marker,)
+        keyed = []
+        try:
+            for item in items:
+                k = key(item)
+                if k[: len(marker)] > marker:
+                    keyed.append((k, item))
+        except TypeError:
+            raise TargetdError(
+                TargetdError.INVALID_ARGUMENT, "marker doesn't match the sort order"
+            )
+
+    if limit is None:
+        keyed.sort(key=lambda ki: ki[0])
+    else:
+        keyed = heapq.nsmallest(limit, keyed, key=lambda ki: ki[0])
+    return [item for k, item in keyed]
+
+
 class TargetdError(Exception):
     # Common
     INVALID = -1
@@ -47,6 +94,7 @@ class TargetdError(Exception):
     NO_SUPPORT = -153
     UNEXPECTED_EXIT_CODE = -303
     INVALID_ARGUMENT = -32602
+    NOT_FOUND_JOB = -113
 
     # Specific to block
     EXISTS_INITIATOR = -52
@@ -76,19 +124,60 @@ def invoke(cmd, raise_exception=True):
     Exec a command returning a tuple (exit code, stdout, stderr) and optionally
     throwing an exception on non-zero exit code.
     """
-    c = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    out = c.communicate()
+    returncode, out, err = run(cmd)
 
     if raise_exception:
-        if c.returncode != 0:
+        if returncode != 0:
             cmd_str = str(cmd)
             raise TargetdError(
                 TargetdError.UNEXPECTED_EXIT_CODE,
                 'Unexpected exit code "%s" %s, out= %s'
-                % (cmd_str, str(c.returncode), str(out[0] + out[1])),
+                % (cmd_str, str(returncode), str(out + err)),
             )
 
-    return c.returncode, out[0].decode("utf-8"), out[1].decode("utf-8")
+    return returncode, out.decode("utf-8"), err.decode("utf-8")
+
+
+def run(cmd):
+    """
+    Exec a command returning a tuple (exit code, stdout, stderr) as bytes.
+    Every command the daemon runs goes through here, so it is accounted for
+    in the statistics.
+    """
+    start = time.monotonic()
+    c = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    out, err = c.communicate()
+    stats.command_ran(cmd, time.monotonic() - start, c.returncode, len(out))
+    return c.returncode, out, err
+
+
+def retrying(cmd):
+    """
+    To be called by retry loops before running cmd again.
+    """
+    stats.command_retried(cmd)
+
+
+def check_concurrently(pools, check, workers=8):
+    """
+    Run check(pool) for each of pools, on up to workers threads at once.
+    Returns the pools which passed, in the same order.  Those for which
+    check raised are left out, with their error logged.
+    """
+    if not pools:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(pools))) as executor:
+        futures = [executor.submit(check, pool) for pool in pools]
+
+    passed = []
+    for pool, future in zip(pools, futures):
+        error = future.exception()
+        if error is None:
+            passed.append(pool)
+        else:
+            log.error("Pool %s is not available: %s" % (pool, error))
+    return passed
 
 
 class Pit(object):
@@ -99,22 +188,43 @@ class Pit(object):
     def __enter__(self):
         self.tar.lock.acquire()
         try:
-            self.tar.client[self.client_id] = True
+            self.tar.client[self.client_id] = self.tar.client.get(self.client_id, 0) + 1
         finally:
             self.tar.lock.release()
 
     def __exit__(self, e_type, e_value, e_traceback):
         self.tar.lock.acquire()
         try:
-            del self.tar.client[self.client_id]
+            self.tar.client[self.client_id] -= 1
+            if not self.tar.client[self.client_id]:
+                del self.tar.client[self.client_id]
         finally:
             self.tar.lock.release()
 
 
 class Tar(object):
-    def __init__(self):
+    """
+    Slows down clients failing to authenticate.  Each failure adds one to
+    the score of the client, which halves every half_life seconds, and the
+    client waits delay * 2 ** (score - 1) seconds, up to max_delay, for its
+    answer.  Delayed answers are sent by a single timer thread, so waiting
+    clients don't hold up any server thread.
+    """
+
+    def __init__(self, delay=2, max_delay=60, half_life=300):
         self.lock = Lock()
+        # Clients with an answer pending, and how many
         self.client = dict()
+        # Clients with failures, their score and when it was last updated
+        self.scores = dict()
+        self.delay = delay
+        self.max_delay = max_delay
+        self.half_life = half_life
+        self.pruned = time.monotonic()
+        self.timers = []
+        self.timer_ids = itertools.count()
+        self.timer_added = Condition(self.lock)
+        self.timer_thread = None
 
     def is_stuck(self, client_id):
         self.lock.acquire()
@@ -127,3 +237,59 @@ class Tar(object):
 
     def pitted(self, client_id):
         return Pit(self, client_id)
+
+    def _score(self, client_id, now):
+        score, updated = self.scores.get(client_id, (0.0, now))
+        return score * 0.5 ** ((now - updated) / self.half_life)
+
+    def failed(self, client_id):
+        """
+        Record a failed authentication of client_id, returns how many seconds
+        it should wait for the answer.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if now - self.pruned > self.half_life:
+                # Forget the clients whose score has decayed away
+                self.scores = dict(
+                    (c, s) for c, s in self.scores.items() if self._score(c, now) > 0.01
+                )
+                self.pruned = now
+            score = self._score(client_id, now) + 1
+            self.scores[client_id] = (score, now)
+        # Past max_delay anyway, and keeps the power in range
+        return min(self.delay * 2 ** min(score - 1, 32), self.max_delay)
+
+    def hold(self, client_id, delay, fn, *args):
+        """
+        Keep client_id pitted for delay seconds, then call fn(*args) from the
+        timer thread.  fn should be quick, the answers to other clients wait
+        for it.
+        """
+        pit = self.pitted(client_id)
+        pit.__enter__()
+        with self.lock:
+            heapq.heappush(
+                self.timers,
+                (time.monotonic() + delay, next(self.timer_ids), pit, fn, args),
+            )
+            if self.timer_thread is None:
+                self.timer_thread = Thread(target=self._timer, name="tarpit")
+                self.timer_thread.daemon = True
+                self.timer_thread.start()
+            self.timer_added.notify()
+
+    def _timer(self):
+        while True:
+            with self.lock:
+                while not self.timers or self.timers[0][0] > time.monotonic():
+                    self.timer_added.wait(
+                        self.timers[0][0] - time.monotonic() if self.timers else None
+                    )
+                _, _, pit, fn, args = heapq.heappop(self.timers)
+            try:
+                fn(*args)
+            except Exception:
+                log.error(traceback.format_exc())
+            finally:
+                pit.__exit__(None, None, None)
@@ -1,16 +1,26 @@
 #!/usr/bin/python3
 
+import asyncio
+import base64
+import importlib
 import unittest
+import http.client
 import json
+import os
 import random
+import socket
+import stat
+import tempfile
 import time
 import string
-from targetd.utils import TargetdError
+import subprocess
+from targetd.utils import TargetdError, Tar, check_concurrently, paginate
 from os import getenv
 from requests.exceptions import ConnectionError
 from test import testlib
-from targetd import nfs
+from targetd import nfs, locks, jobs, stats, idempotency, inventory, lio
 from multiprocessing.pool import ThreadPool
+from threading import Event, Thread
 
 
 def jsonrequest(method, params=None, data=None):
@@ -122,6 +132,675 @@ class NoDaemon(unittest.TestCase):
         i3 = nfs.Export("127.0.0.1", "/mnt/foo", nfs.Export.RO)
         self.assertTrue(i2 != i3)
 
+    def _locked_in_thread(self, lock_manager, resources, shared=False):
+        # Returns True if another thread could lock resources right now
+        t = Thread(target=lambda: lock_manager.locked(resources, shared).__enter__())
+        t.daemon = True
+        t.start()
+        t.join(0.5)
+        return not t.is_alive()
+
+    def test_gp_lock_manager(self):
+        lm = locks.LockManager()
+        with lm.locked([locks.block_pool("vg1"), locks.LIO]):
+            self.assertTrue(self._locked_in_thread(lm, [locks.block_pool("vg2")]))
+            self.assertFalse(self._locked_in_thread(lm, [locks.LIO, locks.NFS]))
+
+        lm = locks.LockManager()
+        with lm.locked([locks.LIO], shared=True):
+            self.assertTrue(self._locked_in_thread(lm, [locks.LIO], shared=True))
+            self.assertFalse(self._locked_in_thread(lm, [locks.LIO]))
+
+        lm = locks.LockManager(serialize=True)
+        with lm.locked([locks.block_pool("vg1")]):
+            self.assertFalse(self._locked_in_thread(lm, [locks.block_pool("vg2")]))
+
+    def test_gp_job_manager(self):
+        def fail():
+            raise TargetdError(TargetdError.NOT_FOUND_VOLUME, "gone")
+
+        jm = jobs.JobManager(workers=1, history=1)
+        status = jm.wait(jm.submit("add", lambda a, b: a + b, 1, 2))
+        self.assertEqual(status["state"], jobs.DONE)
+        self.assertEqual(status["result"], 3)
+
+        status = jm.wait(jm.submit("fail", fail))
+        self.assertEqual(status["state"], jobs.FAILED)
+        self.assertEqual(status["error"]["code"], TargetdError.NOT_FOUND_VOLUME)
+
+        # Only the last finished job is kept
+        self.assertEqual(len(jm.list()), 1)
+
+        # The one worker is busy, so the second job can still be cancelled
+        first = jm.submit("sleep", time.sleep, 0.5)
+        second = jm.submit("sleep", time.sleep, 0.5)
+        self.assertEqual(jm.cancel(second)["state"], jobs.CANCELLED)
+        self.assertEqual(jm.wait(first)["state"], jobs.DONE)
+
+        error_code = 0
+        try:
+            jm.status("nope")
+        except TargetdError as e:
+            error_code = e.error
+        self.assertEqual(error_code, TargetdError.NOT_FOUND_JOB)
+
+        # Waits are capped, and can't be negative
+        job_id = jm.submit("sleep", time.sleep, 0.5)
+        for timeout in (-1, None, "10"):
+            error_code = 0
+            try:
+                jm.wait(job_id, timeout)
+            except TargetdError as e:
+                error_code = e.error
+            self.assertEqual(error_code, TargetdError.INVALID_ARGUMENT)
+        jobs.MAX_WAIT = 0
+        try:
+            state = jm.wait(job_id, 60)["state"]
+            self.assertIn(state, (jobs.QUEUED, jobs.RUNNING))
+        finally:
+            jobs.MAX_WAIT = 30
+
+    def test_gp_job_drain(self):
+        jm = jobs.JobManager(workers=1)
+        jm.submit("sleep", time.sleep, 0.5)
+        jm.submit("sleep", time.sleep, 0)
+        self.assertFalse(jm.drain(0.1))
+        self.assertTrue(jm.drain(5))
+        self.assertEqual([j["state"] for j in jm.list()], [jobs.DONE, jobs.DONE])
+
+    def test_gp_inherited_sockets(self):
+        main = importlib.import_module("targetd.main")
+        tcp = main.tcp_socket(("127.0.0.1", 0))
+        local = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        os.environ["TARGETD_LISTEN_FDS"] = "api=%d,local=%d" % (
+            os.dup(tcp.fileno()),
+            os.dup(local.fileno()),
+        )
+        sockets, activated = main.inherited_sockets()
+        self.assertFalse(activated)
+        self.assertEqual(sorted(sockets), ["api", "local"])
+        self.assertEqual(sockets["api"].getsockname(), tcp.getsockname())
+        self.assertEqual(sockets["local"].family, socket.AF_UNIX)
+        self.assertFalse("TARGETD_LISTEN_FDS" in os.environ)
+        for sock in list(sockets.values()) + [tcp, local]:
+            sock.close()
+
+    def test_gp_handover_failed(self):
+        main = importlib.import_module("targetd.main")
+        # A socket whose fd is gone can't be passed on, we keep serving
+        tcp = main.tcp_socket(("127.0.0.1", 0))
+        tcp.close()
+        self.assertFalse(main.handover(dict(api=tcp)))
+        self.assertFalse(main.handed_over())
+
+    def test_gp_handover_notify(self):
+        main = importlib.import_module("targetd.main")
+        path = os.path.join(tempfile.mkdtemp(), "notify")
+        systemd = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        systemd.bind(path)
+        os.environ["NOTIFY_SOCKET"] = path
+        try:
+            # Nothing to tell until we handed over
+            main.notify_successor()
+            main.successor = subprocess.Popen(["sleep", "10"])
+            main.notify_successor()
+            systemd.settimeout(5)
+            self.assertEqual(systemd.recv(4096), b"MAINPID=%d" % main.successor.pid)
+            systemd.setblocking(False)
+            self.assertRaises(BlockingIOError, systemd.recv, 4096)
+        finally:
+            del os.environ["NOTIFY_SOCKET"]
+            if main.successor is not None:
+                main.successor.kill()
+                main.successor.wait()
+                main.successor = None
+            systemd.close()
+            os.unlink(path)
+
+    def test_gp_metrics_address(self):
+        self.assertEqual(stats.split_address("127.0.0.1:9100"), ("127.0.0.1", 9100))
+        self.assertEqual(stats.split_address(":9100"), ("", 9100))
+        self.assertEqual(stats.split_address("[::1]:9100"), ("::1", 9100))
+        self.assertEqual(stats.split_address("[::]:9100"), ("::", 9100))
+        for address in ("127.0.0.1", "[::1]", "[::1:9100", "host:port"):
+            self.assertRaises(ValueError, stats.split_address, address)
+
+        if not socket.has_ipv6:
+            return
+        server = stats.metrics_service("[::1]:0", lambda: dict())
+        try:
+            port = server.server_address[1]
+            conn = http.client.HTTPConnection("::1", port, timeout=10)
+            conn.request("GET", "/metrics")
+            self.assertEqual(conn.getresponse().status, 200)
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_gp_method_stats(self):
+        ms = stats.MethodStats()
+        ms.call("vol_list", 0.5, 0.001)
+        ms.call("vol_list", 0, 2, TargetdError.INVALID_POOL)
+        ms.response("vol_list", 100)
+
+        vol_list = ms.snapshot()["vol_list"]
+        self.assertEqual(vol_list["calls"], 2)
+        self.assertEqual(vol_list["errors"], {str(TargetdError.INVALID_POOL): 1})
+        self.assertEqual(vol_list["lock_wait"], 0.5)
+        self.assertEqual(vol_list["response_bytes"], 100)
+        buckets = dict((le, n) for le, n in vol_list["duration"]["buckets"])
+        self.assertEqual(buckets[0.005], 1)
+        self.assertEqual(buckets[2.5], 2)
+        self.assertEqual(buckets[None], 2)
+
+        text = stats.prometheus(dict(methods=ms.snapshot()))
+        self.assertTrue('targetd_rpc_calls_total{method="vol_list"} 2\n' in text)
+        self.assertTrue(
+            'targetd_rpc_duration_seconds_bucket{le="+Inf",method="vol_list"} 2\n'
+            in text
+        )
+
+    def test_gp_command_stats(self):
+        self.assertEqual(
+            stats.command_name(["/usr/sbin/btrfs", "subvolume", "list", "-ua", "/p"]),
+            "btrfs subvolume list",
+        )
+        self.assertEqual(stats.command_name(["zfs", "get", "-H"]), "zfs get")
+        self.assertEqual(stats.command_name(["exportfs", "-v"]), "exportfs")
+
+        with stats.call_commands() as commands:
+            stats.command_ran(["zfs", "get", "-H"], 0.5, 0, 10)
+            stats.command_retried(["zfs", "destroy", "p/v"])
+            stats.command_ran(["zfs", "destroy", "p/v"], 0.25, 1, 0)
+        self.assertEqual(commands.count, 2)
+        self.assertEqual(commands.retries, 1)
+        self.assertEqual(commands.seconds, 0.75)
+        self.assertEqual(
+            commands.summary(), "zfs get: 1 in 0.500s, zfs destroy: 1 in 0.250s"
+        )
+
+        zfs_destroy = stats.commands.snapshot()["zfs destroy"]
+        self.assertTrue(zfs_destroy["failures"] >= 1)
+        self.assertTrue(zfs_destroy["retries"] >= 1)
+
+    def test_gp_content_coding(self):
+        # The package exports main() under the same name as the module
+        content_coding = importlib.import_module("targetd.main").content_coding
+
+        self.assertEqual(content_coding("gzip, deflate"), "gzip")
+        self.assertEqual(content_coding("deflate"), "deflate")
+        self.assertEqual(content_coding("gzip;q=0, deflate;q=0.5"), "deflate")
+        self.assertEqual(content_coding("*"), "gzip")
+        self.assertEqual(content_coding("br, identity"), None)
+        self.assertEqual(content_coding(None), None)
+
+    def test_gp_paginate(self):
+        items = [dict(name=n, pool=p) for n in "cab" for p in "xy"]
+
+        def key(i):
+            return (i["name"], i["pool"])
+
+        def names(page):
+            return ["%s%s" % key(i) for i in page]
+
+        # Unpaged, the items are returned as they come
+        self.assertEqual(
+            names(paginate(items, key)), ["cx", "cy", "ax", "ay", "bx", "by"]
+        )
+        self.assertEqual(names(paginate(items, key, limit=3)), ["ax", "ay", "bx"])
+        # The whole key of the last item of a page marks where the next starts
+        self.assertEqual(names(paginate(items, key, 3, ["b", "x"])), ["by", "cx", "cy"])
+        self.assertEqual(names(paginate(items, key, 2, ["a", "y"])), ["bx", "by"])
+        # Its first member alone skips all the items starting with it
+        self.assertEqual(names(paginate(items, key, 2, "a")), ["bx", "by"])
+        self.assertEqual(names(paginate(items, key, marker="c")), [])
+
+        error_code = 0
+        try:
+            paginate(items, key, marker=[1])
+        except TargetdError as e:
+            error_code = e.error
+        self.assertEqual(error_code, TargetdError.INVALID_ARGUMENT)
+
+        error_code = 0
+        try:
+            paginate(items, key, limit=0)
+        except TargetdError as e:
+            error_code = e.error
+        self.assertEqual(error_code, TargetdError.INVALID_ARGUMENT)
+
+    def test_gp_tarpit(self):
+        tar = Tar(delay=2, max_delay=10, half_life=300)
+        self.assertEqual([round(tar.failed("a")) for _ in range(4)], [2, 4, 8, 10])
+        self.assertEqual(round(tar.failed("b")), 2)
+
+        # The score halves every half_life seconds
+        score, updated = tar.scores["a"]
+        tar.scores["a"] = (score, updated - 600)
+        self.assertAlmostEqual(tar.failed("a"), 2 * 2 ** (score / 4), places=3)
+
+        answered = Event()
+        tar.hold("a", 0.1, answered.set)
+        self.assertTrue(tar.is_stuck("a"))
+        self.assertFalse(tar.is_stuck("b"))
+        self.assertTrue(answered.wait(5))
+        time.sleep(0.1)
+        self.assertFalse(tar.is_stuck("a"))
+
+    def test_gp_startup_timings(self):
+        timings = stats.Timings()
+        with timings.step("config"):
+            pass
+        try:
+            with timings.step("lvm initialize"):
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual([n for n, _ in timings.steps], ["config", "lvm initialize"])
+        self.assertTrue(str(timings).startswith("config 0.0"))
+
+    def test_gp_check_concurrently(self):
+        def check(pool):
+            time.sleep(0.2)
+            if pool.startswith("missing"):
+                raise TargetdError(TargetdError.NOT_FOUND_VOLUME_GROUP, pool)
+
+        pools = ["vg%d" % i for i in range(8)] + ["missing1", "missing2"]
+        start = time.monotonic()
+        passed = check_concurrently(pools, check, workers=10)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(passed, pools[:8])
+        self.assertEqual(check_concurrently([], check), [])
+
+    def test_gp_idempotency(self):
+        replies = idempotency.ReplyCache(size=2, ttl=600)
+        runs = []
+
+        def create(name):
+            runs.append(name)
+            if runs.count(name) > 1:
+                raise TargetdError(TargetdError.NAME_CONFLICT, "exists")
+            return name
+
+        params = dict(name="a")
+        self.assertEqual(replies.call("k", "vol_create", params, create, "a"), "a")
+        self.assertEqual(replies.call("k", "vol_create", params, create, "a"), "a")
+        self.assertEqual(runs, ["a"])
+
+        error_code = 0
+        try:
+            replies.call("k", "vol_create", dict(name="b"), create, "b")
+        except TargetdError as e:
+            error_code = e.error
+        self.assertEqual(error_code, TargetdError.INVALID_ARGUMENT)
+
+        # Failures are not kept, and the oldest results make way
+        for _ in range(2):
+            with self.assertRaises(TargetdError):
+                replies.call("k2", "vol_create", params, create, "a")
+        replies.call("k3", "vol_create", dict(name="c"), create, "c")
+        replies.call("k4", "vol_create", dict(name="d"), create, "d")
+        self.assertEqual(list(replies.replies), ["k3", "k4"])
+
+    def test_gp_inventory(self):
+        inv = inventory.Inventory(ttl=600)
+        listed = []
+
+        def fetch():
+            listed.append(1)
+            return [dict(name="a", size=1, uuid="1"), dict(name="b", size=2, uuid="2")]
+
+        self.assertEqual(inv.volume("p", "a", fetch)["size"], 1)
+        self.assertEqual(inv.volume("p", "c", fetch), None)
+        self.assertEqual(len(inv.volumes("p", fetch)), 2)
+        self.assertEqual(len(listed), 1)
+
+        inv.update("p", "c", dict(name="c", size=3, uuid="3"))
+        inv.update("p", "a", None)
+        self.assertEqual(sorted(v["name"] for v in inv.volumes("p", fetch)), ["b", "c"])
+        self.assertEqual(len(listed), 1)
+
+        inv.forget("p")
+        self.assertEqual(inv.volume("p", "c", fetch), None)
+        self.assertEqual(len(listed), 2)
+
+        pools = [dict(name="p", size=10, free_size=5)]
+        self.assertEqual(inv.pool_list(["p"], lambda: pools), pools)
+        self.assertEqual(inv.pool_list(["p"], lambda: []), pools)
+        # Changing a volume changes the free size of its pool
+        inv.update("p", "b", None)
+        self.assertEqual(inv.pool_list(["p"], lambda: []), [])
+
+        # Nothing is kept without a ttl
+        inv = inventory.Inventory(ttl=0)
+        inv.volume("p", "a", fetch)
+        inv.volume("p", "a", fetch)
+        self.assertEqual(len(listed), 4)
+
+    def test_gp_lio_model(self):
+        model = lio.Tpg()
+        model.add_lun(0, "vg:a", "block", "/dev/vg/a")
+        model.add_lun(1, "ram", "rd_mcp", None)
+        model.add_acl("iqn.1")
+        model.add_acl("iqn.2", "g")
+        model.add_acl("iqn.3", "g")
+        model.map("iqn.1", 5, 0)
+        model.map("iqn.2", 0, 0)
+        model.map("iqn.3", 0, 0)
+
+        self.assertEqual(model.block_lun("vg:a"), 0)
+        self.assertEqual(model.block_lun("ram"), None)
+        self.assertEqual(model.mapped_lun("iqn.1", 0), 5)
+        self.assertEqual(model.mapped_lun_ids(0), set([0, 5]))
+        self.assertEqual(model.group_names(), ["g"])
+        self.assertEqual(model.members("g"), ["iqn.2", "iqn.3"])
+        self.assertEqual(model.group_mapped("g"), {0: 0})
+
+        # Removing an initiator unmaps what it had
+        model.remove_acl("iqn.2")
+        model.unmap("iqn.3", 0)
+        self.assertEqual(model.group_mapped("g"), dict())
+        self.assertTrue(model.is_mapped(0))
+        model.unmap("iqn.1", 5)
+        self.assertFalse(model.is_mapped(0))
+
+        model.remove_lun(0)
+        self.assertEqual(model.block_lun("vg:a"), None)
+        self.assertEqual(list(model.luns), [1])
+
+    def test_gp_request_context(self):
+        main = importlib.import_module("targetd.main")
+        req = main.RequestContext(None)
+        listed = []
+
+        def fetch(pool):
+            listed.append(pool)
+            return [pool]
+
+        self.assertEqual(req.memo(("volumes", "p"), fetch, "p"), ["p"])
+        self.assertEqual(req.memo(("volumes", "p"), fetch, "p"), ["p"])
+        self.assertEqual(req.memo(("volumes", "q"), fetch, "q"), ["q"])
+        self.assertEqual(listed, ["p", "q"])
+
+        req.forget(("volumes", "p"))
+        req.forget(("volumes", "r"))
+        req.memo(("volumes", "p"), fetch, "p")
+        self.assertEqual(listed, ["p", "q", "p"])
+
+        # Every call starts afresh
+        main.RequestContext(None).memo(("volumes", "q"), fetch, "q")
+        self.assertEqual(len(listed), 4)
+
+    def test_gp_zfs_udev_path(self):
+        zfs = importlib.import_module("targetd.backends.zfs")
+        saved = zfs.pool_names
+        zfs.pool_names = frozenset(["tank", "tank/sub"])
+        try:
+            self.assertEqual(zfs.split_udev_path("/dev/tank/v"), ("tank", "v"))
+            self.assertEqual(zfs.split_udev_path("/dev/tank/sub/v"), ("tank/sub", "v"))
+            self.assertIsNone(zfs.split_udev_path("/dev/other/v"))
+        finally:
+            zfs.pool_names = saved
+
+    def test_gp_unix_socket(self):
+        main = importlib.import_module("targetd.main")
+        saved = dict(main.config)
+        main.config.update(
+            unix_socket_mode=0o660, unix_socket_group="", unix_socket_uids=[]
+        )
+        path = os.path.join(tempfile.mkdtemp(), "targetd.sock")
+        sock = main.unix_socket(path)
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o660)
+            sock.listen(1)
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            conn, _ = sock.accept()
+            address = main.peer_address(conn)
+            client.close()
+            conn.close()
+            self.assertEqual(
+                address, ("local:%d" % os.getuid(), os.getpid(), os.getuid())
+            )
+
+            self.assertTrue(main.local_authorized(os.getuid()))
+            main.config["unix_socket_uids"] = [os.getuid() + 1]
+            self.assertFalse(main.local_authorized(os.getuid()))
+        finally:
+            main.remove_unix_socket(sock, path)
+            main.config.clear()
+            main.config.update(saved)
+        self.assertFalse(os.path.exists(path))
+
+    def test_gp_config_reload_failed(self):
+        main = importlib.import_module("targetd.main")
+        saved = dict(main.config)
+        path = os.path.join(tempfile.mkdtemp(), "targetd.yaml")
+
+        def reload(text):
+            with open(path, "w") as f:
+                f.write(text)
+                if not text.startswith("-"):
+                    # No block pools, block needs rtslib
+                    f.write("block_pools: []\nzfs_block_pools: []\n")
+            error_code = 0
+            try:
+                main.reload_config(path)
+            except TargetdError as e:
+                error_code = e.error
+            return error_code
+
+        def pool_list():
+            rpc = dict(jsonrpc="2.0", id=1, method="pool_list")
+            return json.loads(main.rpc_response(None, rpc))["result"]
+
+        try:
+            main.config.clear()
+            main.config.update(main.default_config, password="targetd")
+            main.config["block_pools"] = set()
+            main.config["zfs_block_pools"] = set()
+            main.config["fs_pools"] = set()
+            self.assertEqual(reload("password: targetd\n"), 0)
+            good = dict(main.config)
+            mapping = dict(main.mapping)
+
+            for text in (
+                "- password\n",
+                "password: targetd\nfs_pools: 5\n",
+                # Checked by fs.initialize
+                "password: targetd\nfs_pools: [/nonexistent]\n",
+            ):
+                self.assertEqual(reload(text), TargetdError.INVALID)
+                self.assertEqual(main.config, good)
+                self.assertEqual(main.mapping, mapping)
+                self.assertEqual(pool_list(), [])
+        finally:
+            main.config.clear()
+            main.config.update(saved)
+
+    def test_gp_worker_pool(self):
+        main = importlib.import_module("targetd.main")
+        saved = dict(main.config)
+        main.config.update(
+            main.default_config,
+            worker_threads=2,
+            request_queue_depth=1,
+            keepalive_timeout=5,
+            busy_retry_after=7,
+        )
+        entered = []
+        release = Event()
+
+        class Handler(main.TargetHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                if self.path == "/block":
+                    entered.append(self.path)
+                    release.wait(10)
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        server = main.HTTPService(("127.0.0.1", 0), Handler)
+        Thread(target=server.serve_forever, args=(0.1,), daemon=True).start()
+        port = server.server_address[1]
+
+        def post(conn, path="/"):
+            conn.request("POST", path, b"{}")
+            response = conn.getresponse()
+            response.read()
+            return response
+
+        try:
+            self.assertEqual(server.stats()["workers"], 2)
+
+            # Idle persistent connections don't hold up the workers
+            conns = [http.client.HTTPConnection("127.0.0.1", port) for _ in range(3)]
+            for conn in conns:
+                self.assertEqual(post(conn).status, 200)
+            started = time.monotonic()
+            for conn in conns:
+                self.assertEqual(post(conn).status, 200)
+            self.assertLess(time.monotonic() - started, 2)
+
+            # Both workers busy and the queue full, the next one is turned
+            # away
+            blocked = [
+                ThreadPool(1).apply_async(post, (c, "/block")) for c in conns[:2]
+            ]
+            while len(entered) < 2:
+                time.sleep(0.01)
+            queued = ThreadPool(1).apply_async(post, (conns[2],))
+            while server.stats()["queue_depth"] < 1:
+                time.sleep(0.01)
+            # Answered on accept, without reading a request
+            with socket.create_connection(("127.0.0.1", port)) as busy:
+                response = busy.makefile("rb").read()
+            self.assertTrue(response.startswith(b"HTTP/1.1 503 "))
+            self.assertIn(b"\r\nRetry-After: 7\r\n", response)
+            self.assertEqual(server.stats()["rejected"], 1)
+
+            # Nor does a client which doesn't read hold up the answers
+            stalled, peer = socket.socketpair()
+            with peer:
+                stalled.setblocking(False)
+                try:
+                    while True:
+                        stalled.send(b"\0" * 65536)
+                except OSError:
+                    pass
+                started = time.monotonic()
+                server.answer(stalled, main.unauthorized_response())
+                self.assertLess(time.monotonic() - started, 0.5)
+
+            release.set()
+            for result in blocked + [queued]:
+                self.assertEqual(result.get(10).status, 200)
+        finally:
+            release.set()
+            server.shutdown()
+            server.server_close()
+            self.assertTrue(server.drain(5))
+            for conn in conns:
+                conn.close()
+            main.config.clear()
+            main.config.update(saved)
+
+    def test_gp_asyncio_engine(self):
+        main = importlib.import_module("targetd.main")
+        from targetd.aioserver import AsyncService
+
+        saved = (dict(main.config), dict(main.mapping))
+        main.config.update(
+            main.default_config,
+            user="admin",
+            password="targetd",
+            worker_threads=1,
+            request_queue_depth=0,
+            busy_retry_after=7,
+        )
+        release = Event()
+
+        def items(req, n):
+            for i in range(n):
+                yield dict(name="vol%d" % i, pad="x" * 100)
+
+        main.mapping.update(
+            echo=lambda req, value: value,
+            items=items,
+            block=lambda req: release.wait(10),
+        )
+
+        server = AsyncService(dict(api=main.tcp_socket(("127.0.0.1", 0))))
+        port = server.sockets["api"].getsockname()[1]
+        loop = asyncio.new_event_loop()
+        # Signals are for the main thread only
+        loop.add_signal_handler = lambda *args: None
+        serving = Thread(target=loop.run_until_complete, args=(server._serve(),))
+        serving.start()
+
+        headers = {
+            "Authorization": "Basic "
+            + base64.b64encode(b"admin:targetd").decode("utf-8")
+        }
+
+        def call(conn, method, params=None):
+            body = json.dumps(
+                dict(jsonrpc="2.0", id=1, method=method, params=params or {})
+            )
+            conn.request("POST", "/targetrpc", body, headers)
+            response = conn.getresponse()
+            return response, response.read()
+
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+            # Persistent connections serve several requests
+            for value in ("a", "b"):
+                response, data = call(conn, "echo", dict(value=value))
+                self.assertEqual(response.status, 200)
+                self.assertEqual(json.loads(data)["result"], value)
+            # Same as the threading engine
+            self.assertEqual(
+                response.getheader("Server"),
+                main.TargetHandler.version_string(main.TargetHandler),
+            )
+
+            # Large results are streamed
+            n = 2 * main.STREAM_CHUNK_SIZE // 100
+            response, data = call(conn, "items", dict(n=n))
+            self.assertEqual(response.getheader("Transfer-Encoding"), "chunked")
+            self.assertEqual(len(json.loads(data)["result"]), n)
+
+            response, data = call(conn, "nope")
+            self.assertEqual(json.loads(data)["error"]["code"], -32601)
+            self.assertEqual(server.stats()["workers"], 1)
+
+            # The one worker busy and no queue, the next call is turned away
+            blocked = ThreadPool(1).apply_async(call, (conn, "block"))
+            while not server.pending:
+                time.sleep(0.01)
+            other = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+            response, _ = call(other, "echo", dict(value="c"))
+            self.assertEqual(response.status, 503)
+            self.assertEqual(response.getheader("Retry-After"), "7")
+            self.assertEqual(server.stats()["rejected"], 1)
+            release.set()
+            self.assertEqual(blocked.get(10)[0].status, 200)
+            conn.close()
+            other.close()
+        finally:
+            release.set()
+            loop.call_soon_threadsafe(server.stopping.set)
+            serving.join(10)
+            loop.close()
+            server.sockets["api"].close()
+            main.config.clear()
+            main.config.update(saved[0])
+            main.mapping.clear()
+            main.mapping.update(saved[1])
+        self.assertFalse(serving.is_alive())
+
 
 class TestConnect(unittest.TestCase):
     def _test_ep_bad_auth(self, username=True):
@@ -249,6 +928,43 @@ class TestConnect(unittest.TestCase):
         # Basic good path
         jsonrequest("pool_list")
 
+    def test_gp_batch(self):
+        results = testlib.rpc_batch(
+            [("pool_list", None), ("pool_listing", None), ("initiator_list", None)]
+        )
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual([r["id"] for r in results], sorted(r["id"] for r in results))
+        self.assertTrue("result" in results[0])
+        self.assertEqual(results[1]["error"]["code"], -32601)
+        self.assertTrue("result" in results[2])
+
+    def test_gp_stats_get(self):
+        stats = jsonrequest("stats_get")
+        self.assertTrue("handshakes_full" in stats["tls"])
+        self.assertTrue("handshakes_resumed" in stats["tls"])
+        jsonrequest("pool_list")
+        stats = jsonrequest("stats_get")
+        self.assertTrue(stats["methods"]["pool_list"]["calls"] >= 1)
+
+    def test_gp_config_reload(self):
+        # The config file didn't change, neither do the pools
+        pools = jsonrequest("pool_list")
+        self.assertEqual(jsonrequest("config_reload"), dict(added=[], removed=[]))
+        self.assertEqual(
+            sorted(p["name"] for p in jsonrequest("pool_list")),
+            sorted(p["name"] for p in pools),
+        )
+
+    def test_gp_streamed_list(self):
+        # Single calls of list methods are streamed, batched ones aren't
+        for pool in jsonrequest("pool_list"):
+            if pool["type"] == "block":
+                params = dict(pool=pool["name"])
+                streamed = jsonrequest("vol_list", params)
+                batched = testlib.rpc_batch([("vol_list", params)])[0]["result"]
+                self.assertEqual(streamed, batched)
+
     def test_ep_request_too_big(self):
         request = rs(None, 1) * (1024 * 128)
         error_code = 0
@@ -528,6 +1244,76 @@ class TestTargetd(unittest.TestCase):
             self._vol_destroy(block_pool, vol_copy)
             self._vol_destroy(block_pool, vol)
 
+    def test_gp_vol_copy_job(self):
+        for block_pool in self._block_pools():
+            vol_name = rs(length=6)
+            vol = TestTargetd._vol_create(block_pool, vol_name)
+
+            job_id = jsonrequest(
+                "vol_copy",
+                {
+                    "pool": block_pool.name,
+                    "vol_orig": vol.name,
+                    "vol_new": vol_name + "_copy",
+                    "async": True,
+                },
+            )
+            job = jsonrequest("job_wait", dict(job_id=job_id, timeout=60))
+            self.assertEqual(job["state"], "done")
+            self.assertTrue(job_id in [j["id"] for j in jsonrequest("job_list")])
+
+            vol_copy = TestTargetd._vol_list(block_pool, vol_name + "_copy")[0]
+            self._vol_destroy(block_pool, vol_copy)
+
+            # Failures are reported in the job
+            job_id = jsonrequest(
+                "vol_copy",
+                {
+                    "pool": block_pool.name,
+                    "vol_orig": vol_name + "_missing",
+                    "vol_new": vol_name + "_copy",
+                    "async": True,
+                },
+            )
+            job = jsonrequest("job_wait", dict(job_id=job_id, timeout=60))
+            self.assertEqual(job["state"], "failed")
+            self.assertEqual(job["error"]["code"], TargetdError.NOT_FOUND_VOLUME)
+
+            self._vol_destroy(block_pool, vol)
+
+    def test_gp_vol_list_pages(self):
+        for block_pool in self._block_pools():
+            prefix = rs(length=6)
+            vols = [
+                TestTargetd._vol_create(block_pool, "%s_%d" % (prefix, i))
+                for i in range(3)
+            ]
+
+            # Only pages are sorted
+            listed = sorted(
+                jsonrequest("vol_list", dict(pool=block_pool.name, name_prefix=prefix)),
+                key=lambda v: v["name"],
+            )
+            self.assertEqual([v["name"] for v in listed], sorted(v.name for v in vols))
+
+            page = jsonrequest(
+                "vol_list", dict(pool=block_pool.name, name_prefix=prefix, limit=2)
+            )
+            self.assertEqual(page, listed[:2])
+            page = jsonrequest(
+                "vol_list",
+                dict(
+                    pool=block_pool.name,
+                    name_prefix=prefix,
+                    limit=2,
+                    marker=page[-1]["name"],
+                ),
+            )
+            self.assertEqual(page, listed[2:])
+
+            for v in vols:
+                self._vol_destroy(block_pool, v)
+
     def test_ep_copy_missing_volume(self):
         for block_pool in self._block_pools():
             vol_name = rs(length=6)
@@ -668,6 +1454,20 @@ class TestTargetd(unittest.TestCase):
                 self._export_destroy(export)
                 self._vol_destroy(block_pool, vol)
 
+    def test_gp_vol_create_retry(self):
+        for block_pool in self._block_pools():
+            params = dict(
+                pool=block_pool.name,
+                name=rs(length=6),
+                size=1024 * 1024 * 100,
+                idempotency_key=rs(length=16),
+            )
+            jsonrequest("vol_create", params)
+            # A retry with the key doesn't fail with NAME_CONFLICT
+            jsonrequest("vol_create", params)
+            vol = TestTargetd._vol_list(block_pool, params["name"])[0]
+            self._vol_destroy(block_pool, vol)
+
     def test_ep_vol_name_collision(self):
         for block_pool in self._block_pools():
             vol_name = "some_block_vol"
@@ -104,6 +104,16 @@ if [[ "$CONNECT" = "http" ]]; then
      sed -e 's/ssl: true/ssl: false/' -i /etc/target/targetd.yaml
 fi
 
+ENGINE="${TARGETD_UT_ENGINE:-threading}"
+
+echo "ENGINE = $ENGINE"
+
+# Both server engines serve the same API, the tests run against either
+if [[ "$ENGINE" != "threading" ]]; then
+    echo "Changing targetd.yaml to use the $ENGINE server engine"
+    echo "server_engine: $ENGINE" >> /etc/target/targetd.yaml
+fi
+
 echo "======= /etc/target/targetd.yaml contents ============="
 cat /etc/target/targetd.yaml
 echo "======================================================="
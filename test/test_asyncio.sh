@@ -0,0 +1,11 @@
+#!/bin/bash
+
+
+# Getting an env variable to work with circle ci is problematic...
+
+SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
+
+export TARGETD_UT_ENGINE=asyncio
+
+"$SCRIPT_DIR"/test.sh "$@" || exit 1
+exit 0
\ No newline at end of file
@@ -54,6 +54,30 @@ def rpc(method, params=None, data=None):
         raise TargetdError(r.status_code, str(r))
 
 
+def rpc_batch(calls):
+    """
+    Send a jsonrpc-2.0 batch, `calls` is a list of (method, params) tuples.
+    Returns the list of response objects, in request order.
+    """
+    global id_num
+    auth_info = HTTPBasicAuth(user, password)
+
+    batch = []
+    for method, params in calls:
+        batch.append(dict(id=id_num, method=method, params=params, jsonrpc="2.0"))
+        id_num += 1
+
+    url = "%s://%s:%s%s" % (proto, host, port, rpc_path)
+    r = requests.post(
+        url, data=json.dumps(batch).encode("utf-8"), auth=auth_info, verify=cert_file
+    )
+    if r.status_code == 200:
+        return r.json()
+    else:
+        # Transport error
+        raise TargetdError(r.status_code, str(r))
+
+
 def test_bad_authenticate():
     auth_info = HTTPBasicAuth("bad_user", "bad_password")
     data = json.dumps(